@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Atomic file replacement for every piece of state and cache the calendar keeps on disk. Data is written to a uniquely
+named temporary file next to its destination and then renamed over it, so readers (the next run, node_exporter) see
+either the old or the new contents, never a truncated file, and concurrent writers of one path never share a
+temporary file.
+"""
+
+import os
+import tempfile
+
+# Temporary files are created private (0600); the finished file gets the usual mode, e.g. for node_exporter to read
+FILE_MODE = 0o644
+
+
+def write_atomic(path, data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    directory, name = os.path.split(path)
+    with tempfile.NamedTemporaryFile(dir=directory or ".", prefix=f".{name}.", suffix=".tmp", delete=False) as fo:
+        try:
+            fo.write(data)
+        except BaseException:
+            fo.close()
+            os.remove(fo.name)
+            raise
+    try:
+        os.chmod(fo.name, FILE_MODE)
+        os.replace(fo.name, path)
+    except BaseException:
+        os.remove(fo.name)
+        raise
+
+
+if __name__ == "__main__":
+    import threading
+
+    # Concurrent writers of the same path: the result is always one writer's complete data
+    with tempfile.TemporaryDirectory() as scratch:
+        path = f"{scratch}/state.bin"
+        writers = [threading.Thread(target=write_atomic, args=(path, bytes([i]) * 100000)) for i in range(8)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        with open(path, "rb") as fo:
+            data = fo.read()
+        print(len(data), len(set(data)), sorted(os.listdir(scratch)))
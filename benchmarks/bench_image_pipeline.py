@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the screenshot -> bitplane stage at 960x768: the NumPy pipeline against a per-pixel Pillow reference
+with the same semantics, and against epd_hidapi's Image when the submodule is available. With dithering off the
+NumPy output must be byte-identical to the reference and, when it can be imported, to epd_hidapi's output (the path
+it replaces); the script exits non-zero otherwise.
+
+Usage: python3 benchmarks/bench_image_pipeline.py [image.png]
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from display_engine.image import ImagePipeline
+
+WIDTH = 960
+HEIGHT = 768
+PALETTE = [(255, 255, 255), (0, 0, 0), (255, 0, 0)]
+
+
+def reference_pipeline(infile, threshold=200):
+    # Straightforward per-pixel implementation of resize/rotate/quantize (no dither)/extract
+    image = Image.open(infile).convert("RGB")
+    if image.size != (WIDTH, HEIGHT):
+        image = image.resize((WIDTH, HEIGHT), Image.NEAREST)
+    image = image.rotate(90, expand=True)
+
+    width, height = image.size
+    black = bytearray(width * height // 8)
+    red = bytearray(width * height // 8)
+    data = image.tobytes()
+    for i in range(width * height):
+        pixel = data[i * 3:i * 3 + 3]
+        best = min(range(len(PALETTE)),
+                   key=lambda c: (sum((pixel[k] - PALETTE[c][k]) ** 2 for k in range(3)), c))
+        r, g, b = PALETTE[best]
+        bit = 0x80 >> (i % 8)
+        if g < threshold and b < threshold:
+            if r < threshold:
+                black[i // 8] |= bit
+            else:
+                red[i // 8] |= bit
+    return bytes(black), bytes(red)
+
+
+def numpy_pipeline(infile, dither=False, threshold=200):
+    image = ImagePipeline(infile)
+    image.resize(width=WIDTH, height=HEIGHT)
+    image.rotate(rotation=90)
+    image.quantize(dither=dither)
+    image.extract(threshold=threshold)
+    return image.bit_array_black, image.bit_array_red
+
+
+def epd_pipeline(infile, dither=False, threshold=200):
+    from epd_hidapi.host.image import Image as EpdImage
+    image = EpdImage(infile)
+    image.resize(width=WIDTH, height=HEIGHT)
+    image.rotate(rotation=90)
+    image.quantize(dither=dither)
+    image.extract(threshold=threshold)
+    return image.bit_array_black, image.bit_array_red
+
+
+def synthetic_frame(outfile):
+    # Mostly white frame with text-like black and red blocks and some gray anti-aliasing
+    image = Image.new("RGB", (WIDTH, HEIGHT), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    for i in range(35):
+        x = (i % 7) * WIDTH // 7
+        y = 250 + (i // 7) * 100
+        draw.text((x + 50, y), str(i + 1), fill=(0, 0, 0))
+        draw.rectangle((x + 5, y + 30, x + 60, y + 45), fill=(0, 0, 0) if i % 3 else (255, 0, 0))
+        draw.rectangle((x + 65, y + 30, x + 120, y + 45), fill=(108, 117, 125))
+    draw.ellipse((400, 40, 560, 200), fill=(255, 0, 0))
+    image.save(outfile)
+
+
+def timed(fn, *args, repeat=3, **kwargs):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    with tempfile.TemporaryDirectory() as scratch:
+        infile = sys.argv[1] if len(sys.argv) > 1 else f"{scratch}/frame.png"
+        if len(sys.argv) <= 1:
+            synthetic_frame(infile)
+
+        ref_time, ref = timed(reference_pipeline, infile, repeat=1)
+        np_time, result = timed(numpy_pipeline, infile)
+        np_dither_time, _ = timed(numpy_pipeline, infile, dither=True)
+
+        print(f"reference (per-pixel):   {ref_time * 1000:8.1f} ms")
+        print(f"numpy:                   {np_time * 1000:8.1f} ms")
+        print(f"numpy (dither):          {np_dither_time * 1000:8.1f} ms")
+
+        try:
+            epd_time, epd = timed(epd_pipeline, infile)
+            print(f"epd_hidapi Image:        {epd_time * 1000:8.1f} ms")
+        except ImportError:
+            epd = None
+            print("epd_hidapi Image:        not available (submodule not checked out)")
+
+        planes = tuple(bytes(plane) for plane in result)
+        identical = planes == ref
+        print(f"byte-identical to reference (no dither): {identical}")
+        if epd is not None:
+            matches_epd = planes == tuple(bytes(plane) for plane in epd)
+            print(f"byte-identical to epd_hidapi (no dither): {matches_epd}")
+            identical = identical and matches_epd
+        return 0 if identical else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
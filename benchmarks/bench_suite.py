@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite over synthetic calendars (see benchmarks/synthetic.py). For every scenario it times the stages of an
+update with the repository's own code: IcalHelper.retrieve_events against feeds served from a local HTTP server
+(cold cache, cold cache with pruning, and warm cache), GcalHelper.retrieve_events against a stub Calendar service,
+should_refresh, build_calendar_list, build_view, the HTML generation of process_inputs, the Pillow backend and the
+NumPy image pipeline. The HTML screenshot itself needs cutycapt and an X server, so it isn't timed here. The Pillow
+case renders into the scratch directory, never over the panel's render_engine/calendar.png.
+
+Results (median seconds per case) can be saved as a baseline and later runs compared against it; the comparison
+fails if any case got slower than the allowed ratio.
+
+Usage:
+    python3 benchmarks/bench_suite.py [--scenario small] [--repeat 5] [--save] [--compare] [--max-ratio 1.25]
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import argparse
+import datetime as dt
+import json
+import logging
+import platform
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pytz import timezone
+
+from benchmarks.synthetic import SCENARIOS, StubCalendarService, generate_events, gcal_items, ics_feed
+
+DEFAULT_BASELINE = os.path.join(here, "baseline.json")
+
+# Differences below this many seconds are timer noise, whatever the ratio (sub-millisecond cases)
+NOISE_FLOOR = 0.001
+
+TZ = "America/Los_Angeles"
+WINDOW_START = dt.date(2024, 9, 1)
+WINDOW_DAYS = 35
+THRESHOLD_HOURS = 24
+
+# Settings the render cases need; the suite doesn't depend on a local config.json
+BENCH_CONFIG = {
+    "displayTZ": TZ,
+    "thresholdHours": THRESHOLD_HOURS,
+    "maxEventsPerDay": 3,
+    "batteryDisplayMode": 0,
+    "weekStartDay": 6,
+    "numWeeks": WINDOW_DAYS // 7,
+    "dayOfWeekText": ["M", "T", "W", "T", "F", "S", "S"],
+    "screenWidth": 960,
+    "screenHeight": 768,
+    "is24h": False,
+    "renderBackend": "pillow",
+}
+
+
+def serve_feeds(feeds):
+    # Serve {path: bytes} over HTTP with ETags, so the feed cache sees 304s on unchanged feeds like it would live
+    class FeedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = feeds.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            etag = f'"{hash(body)}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(fn, repeat, setup=None):
+    # Median wall time of fn over repeat runs; setup (untimed) runs before each and its result is passed to fn.
+    # Without a setup, one untimed call first warms up caches (compiled templates, fonts) like a daemon would.
+    times = []
+    result = fn() if setup is None else None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        result = fn(arg) if setup else fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def run_scenario(scenario, repeat, scratch):
+    from config import Config
+    from fingerprint import FingerprintStore
+    from gcal_engine.gcal import GcalHelper
+    from ical_engine.ical import IcalHelper
+    from maginkcal import should_refresh
+    from render_engine.render import RenderHelper
+
+    tz = timezone(TZ)
+    startDatetime = tz.localize(dt.datetime.combine(WINDOW_START, dt.datetime.min.time()))
+    endDatetime = tz.localize(dt.datetime.combine(
+        WINDOW_START + dt.timedelta(days=WINDOW_DAYS - 1), dt.datetime.max.time()))
+    today = WINDOW_START + dt.timedelta(days=3)
+
+    specs = generate_events(scenario, WINDOW_START, WINDOW_DAYS)
+    by_calendar = [[spec for spec in specs if spec["calendar"] == i] for i in range(scenario.calendars)]
+    results = {}
+
+    # iCal: one feed per calendar, served locally
+    feeds = {f"/{scenario.name}-{i}.ics": ics_feed(cal_specs).encode("utf-8")
+             for i, cal_specs in enumerate(by_calendar)}
+    server = serve_feeds(feeds)
+    calendars = [{"type": "ical", "summary": path, "id": f"http://127.0.0.1:{server.server_port}{path}"}
+                 for path in feeds]
+
+    def ical_run(cache_dir, prune=False):
+        return IcalHelper(calendars, cache_dir=cache_dir, prune=prune).retrieve_events(
+            startDatetime, endDatetime, tz, THRESHOLD_HOURS)
+
+    try:
+        results["ical_cold"], ical_events = measure(
+            ical_run, repeat, setup=lambda: tempfile.mkdtemp(dir=scratch))
+        results["ical_cold_pruned"], _ = measure(
+            lambda cache_dir: ical_run(cache_dir, prune=True), repeat, setup=lambda: tempfile.mkdtemp(dir=scratch))
+        warm_dir = tempfile.mkdtemp(dir=scratch)
+        results["ical_warm"], _ = measure(lambda: ical_run(warm_dir), repeat)
+    finally:
+        server.shutdown()
+
+    # Google Calendar: the same events as API items, through a stub service (no sync store, batched)
+    service = StubCalendarService({f"cal{i}": gcal_items(cal_specs) for i, cal_specs in enumerate(by_calendar)})
+    gcal_calendars = [{"type": "gcal", "id": f"cal{i}"} for i in range(scenario.calendars)]
+    gcalService = GcalHelper(service=service)
+    results["gcal"], events = measure(lambda: gcalService.retrieve_events(
+        gcal_calendars, startDatetime, endDatetime, tz, THRESHOLD_HOURS), repeat)
+
+    # Change detection, against a fingerprint from a previous run with the same events (the common case)
+    store = FingerprintStore(path=os.path.join(scratch, f"{scenario.name}-last.json"))
+    results["should_refresh"], _ = measure(lambda: should_refresh(events, today, store=store), repeat)
+
+    # Rendering
+    config_file = os.path.join(scratch, "config.json")
+    with open(config_file, "w") as fo:
+        json.dump(BENCH_CONFIG, fo)
+    config = Config(config_file)
+    renderService = RenderHelper(events=events, start_date=WINDOW_START, today=today, config=config)
+    results["build_calendar_list"], _ = measure(lambda: renderService.build_calendar_list(WINDOW_DAYS), repeat)
+    results["build_view"], view = measure(lambda: renderService.build_view(config), repeat)
+    results["render_html"], _ = measure(lambda: renderService.render_html(view), repeat)
+    frame = os.path.join(scratch, f"{scenario.name}-calendar.png")
+    results["render_pillow"], _ = measure(lambda: renderService.process_inputs(view, outfile=frame), repeat)
+
+    # Image pipeline, on the frame the Pillow backend just rendered
+    from display_engine.image import ImagePipeline
+
+    def image_run():
+        image = ImagePipeline(frame)
+        image.resize(width=config.screenWidth, height=config.screenHeight)
+        image.rotate(rotation=90)
+        image.quantize(dither=True)
+        image.extract(threshold=200)
+        return image
+
+    results["image_pipeline"], _ = measure(image_run, repeat)
+
+    counts = {"events": len(specs), "ical_events": len(ical_events), "gcal_events": len(events),
+              "feed_bytes": sum(len(body) for body in feeds.values())}
+    return results, counts
+
+
+def compare(results, baseline, max_ratio):
+    # Print each case against the baseline; returns the cases that regressed
+    regressions = []
+    for scenario, cases in results.items():
+        for case, seconds in cases.items():
+            base = baseline.get("results", {}).get(scenario, {}).get(case)
+            if not base:
+                print(f"  {scenario:8s} {case:20s} {seconds * 1000:10.2f} ms   (no baseline)")
+                continue
+            ratio = seconds / base
+            regressed = ratio > max_ratio and seconds - base > NOISE_FLOOR
+            flag = "  REGRESSION" if regressed else ""
+            print(f"  {scenario:8s} {case:20s} {seconds * 1000:10.2f} ms   {ratio:5.2f}x of {base * 1000:.2f} ms{flag}")
+            if regressed:
+                regressions.append((scenario, case, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the update pipeline on synthetic calendars")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="compare the results against the baseline")
+    parser.add_argument("--max-ratio", type=float, default=1.25,
+                        help="slowest allowed time relative to the baseline when comparing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    counts = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        for name in args.scenario or list(SCENARIOS):
+            print(f"Running {name}...")
+            results[name], counts[name] = run_scenario(SCENARIOS[name], args.repeat, scratch)
+            print(f"  {counts[name]}")
+
+    for scenario, cases in results.items():
+        for case, seconds in cases.items():
+            print(f"  {scenario:8s} {case:20s} {seconds * 1000:10.2f} ms")
+
+    status = 0
+    if args.compare:
+        try:
+            with open(args.baseline) as fo:
+                baseline = json.load(fo)
+        except FileNotFoundError:
+            print(f"No baseline at {args.baseline}; run with --save first")
+            return 1
+        print(f"Compared with the baseline from {baseline.get('saved')} ({baseline.get('python')}):")
+        regressions = compare(results, baseline, args.max_ratio)
+        if regressions:
+            print(f"{len(regressions)} case(s) slower than {args.max_ratio}x the baseline")
+            status = 1
+
+    if args.save:
+        with open(args.baseline, "w") as fo:
+            json.dump({
+                "saved": dt.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "repeat": args.repeat,
+                "counts": counts,
+                "results": results,
+            }, fo, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of calendar HTML generation for 35 days x 20 events: the precompiled fragments used by RenderHelper
+against building the same markup with nested render_engine.template.template() calls and re-reading the template
+file. Both outputs must be identical.
+
+Usage: python3 benchmarks/bench_template.py [--repeat 50]
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import argparse
+import datetime as dt
+import time
+
+from render_engine.render import GRID_HEIGHT_REM, RenderHelper
+from render_engine.template import template as t
+
+NUM_DAYS = 35
+EVENTS_PER_DAY = 20
+
+
+def synthetic_view(start_date, today):
+    days = []
+    for i in range(NUM_DAYS):
+        events = []
+        for j in range(EVENTS_PER_DAY):
+            events.append({
+                "time": "" if j % 5 == 0 else f"{j % 12 + 1}:30P",
+                "summary": f"Event {j} on day {i} – café",
+                "arrow": "rarr" if j % 7 == 0 else "",
+                "text_style": "text-danger" if j % 3 == 0 else "",
+                "badge_style": "badge-danger" if j % 3 == 0 else "badge-dark",
+            })
+        days.append({"date": start_date + dt.timedelta(days=i), "style": "date", "events": events, "more": 2})
+    return {
+        "today": today,
+        "date_text": f"{today.month}/{today.day}",
+        "battery_text": "batteryHide",
+        "days_of_week": ["S", "M", "T", "W", "T", "F", "S"],
+        "days": days,
+    }
+
+
+def legacy_render(path, view):
+    # The markup as it was built before fragments were precompiled
+    days_of_week = '\n'.join(t('li', c='font-weight-bold text-uppercase', body=d) for d in view["days_of_week"])
+    cal_events = []
+    todays_events = []
+    for day in view["days"]:
+        events = []
+        for event in day["events"]:
+            summary = event["summary"]
+            if event["arrow"]:
+                summary = t('b', body=f"&{event['arrow']};") + summary
+            badge = "" if not event["time"] else t('span', c=f'badge {event["badge_style"]}', body=event["time"])
+            events.append(t('div', c=f'event {event["text_style"]}', body=(
+                badge, " ", t('b', body=summary.encode('ascii', 'xmlcharrefreplace').decode("utf-8")))))
+        if day["more"]:
+            events.append(t('div', c='event text-muted', body=(t('i', body=f"+{day['more']} more..."))))
+        cal_events.append(t('li', body=(t('div', c=day["style"], body=day["date"].day), "".join(events))))
+        if day["date"] == view["today"]:
+            todays_events = events
+
+    with open(f"{path}/calendar_template.html", 'r') as fo:
+        calendar_template = fo.read()
+    return calendar_template.format(
+        date=view["date_text"], row_height=f"{GRID_HEIGHT_REM / (len(view['days']) // 7):g}", battery_text=view["battery_text"], days_of_week=days_of_week,
+        events_month='\n'.join(cal_events), events_today="\n".join(todays_events)).encode("utf-8")
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark calendar HTML generation")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    start_date = dt.date(2024, 9, 1)
+    today = dt.date(2024, 9, 2)
+    view = synthetic_view(start_date, today)
+    renderService = RenderHelper(events=[], start_date=start_date, today=today)
+
+    legacy_time, legacy = timed(lambda: legacy_render(renderService._path, view), args.repeat)
+    compiled_time, compiled = timed(lambda: renderService.render_html(view), args.repeat)
+
+    print(f"{NUM_DAYS} days x {EVENTS_PER_DAY} events, {len(compiled)} bytes")
+    print(f"nested template() calls: {legacy_time * 1000:8.2f} ms")
+    print(f"precompiled fragments:   {compiled_time * 1000:8.2f} ms")
+    print(f"identical output: {legacy == compiled}")
+    return 0 if legacy == compiled else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the bitplane transfer over a loopback fake device. The device decodes the stream like the
+firmware would (and checks that the planes round-trip exactly), while the link is modelled as a full-speed USB HID
+interrupt endpoint: one 64 byte report per interval in each direction. Raw and PackBits streams of the same frame use
+the same windowed protocol, so the difference is the compression alone; host encoding time is measured for real.
+
+Usage: python3 benchmarks/bench_transfer.py [--interval-ms 1.0] [image.png]
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import argparse
+import datetime as dt
+import tempfile
+import time
+import zlib
+from collections import deque
+
+from display_engine.codec import (ACK, CODEC_PACKBITS, PAYLOAD_SIZE, REPORT_SIZE, START, StreamUploader,
+                                  packbits_decode)
+from display_engine.image import ImagePipeline
+from render_engine.raster import RasterRenderer
+
+WIDTH = 960
+HEIGHT = 768
+
+
+class LoopbackPanel:
+    # Fake device: decodes what it receives, acks like the firmware, and keeps a modelled clock of the link
+
+    def __init__(self, interval, ack_every=4):
+        self.interval = interval
+        self.ack_every = ack_every
+        self.clock = 0.0
+        self.acks = deque()
+        self.planes = {}
+        self.reports = 0
+        self.header = None
+
+    def write_report(self, report):
+        assert len(report) == REPORT_SIZE
+        self.clock += self.interval
+        self.reports += 1
+
+        if self.header is None:
+            kind, plane, codec, raw_length, payload_length, crc = START.unpack(report[:START.size])
+            assert kind == b"S"
+            self.header = (plane, codec, raw_length, payload_length, crc)
+            self.payload = bytearray()
+            self.received = 0
+            return
+
+        plane, codec, raw_length, payload_length, crc = self.header
+        assert report[0] == self.received % 256, "out of order report"
+        self.payload.extend(report[1:1 + min(PAYLOAD_SIZE, payload_length - len(self.payload))])
+        self.received += 1
+
+        done = len(self.payload) == payload_length
+        status = 0
+        if done:
+            data = packbits_decode(bytes(self.payload)) if codec == CODEC_PACKBITS else bytes(self.payload)
+            status = 0 if len(data) == raw_length and zlib.crc32(data) == crc else 1
+            self.planes[plane] = data
+            self.header = None
+        if done or self.received % self.ack_every == 0:
+            # The ack goes out on the next IN interval
+            self.acks.append((self.clock + self.interval, ACK.pack(b"A", (self.received - 1) % 256, status)))
+
+    def read_report(self, timeout_ms):
+        if not self.acks:
+            return None
+        ready, report = self.acks.popleft()
+        self.clock = max(self.clock, ready)
+        return report
+
+
+def calendar_frame(outfile):
+    # A rendered calendar with a few events a day, through the Pillow backend
+    start_date = dt.date(2024, 9, 1)
+    days = []
+    for i in range(35):
+        events = [{"time": "" if j == 0 else f"{j + 8}:00A", "summary": f"Event {j} on day {i + 1}",
+                   "arrow": "", "text_style": "text-danger" if (i + j) % 5 == 0 else "",
+                   "badge_style": "badge-danger" if (i + j) % 5 == 0 else "badge-dark"}
+                  for j in range(i % 4)]
+        days.append({"date": start_date + dt.timedelta(days=i), "style": "date", "events": events, "more": 0})
+    view = {"today": start_date + dt.timedelta(days=2), "date_text": "9/3", "battery_text": "batteryHide",
+            "days_of_week": ["S", "M", "T", "W", "T", "F", "S"], "days": days}
+    RasterRenderer(width=WIDTH, height=HEIGHT).render(view, outfile)
+
+
+def planes_for(infile, dither):
+    image = ImagePipeline(infile)
+    image.resize(width=WIDTH, height=HEIGHT)
+    image.rotate(rotation=90)
+    image.quantize(dither=dither)
+    image.extract(threshold=200)
+    return image.bit_array_black, image.bit_array_red
+
+
+def transfer(black, red, compress, interval):
+    panel = LoopbackPanel(interval)
+    start = time.perf_counter()
+    StreamUploader(panel, compress=compress).upload(black, red)
+    host = time.perf_counter() - start
+    assert panel.planes == {0: black, 1: red}, "planes did not round-trip"
+    return panel.reports, panel.clock, host
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark raw and compressed bitplane transfer")
+    parser.add_argument("--interval-ms", type=float, default=1.0, help="report interval of the modelled link")
+    parser.add_argument("image", nargs="?", help="frame to send (default: a rendered synthetic calendar)")
+    args = parser.parse_args()
+    interval = args.interval_ms / 1000
+
+    with tempfile.TemporaryDirectory() as scratch:
+        infile = args.image
+        if infile is None:
+            infile = f"{scratch}/frame.png"
+            calendar_frame(infile)
+
+        for dither in (False, True):
+            black, red = planes_for(infile, dither)
+            print(f"frame (dither={dither}): {len(black) + len(red)} bytes of planes")
+            results = {}
+            for compress in (False, True):
+                reports, link, host = transfer(black, red, compress, interval)
+                results[compress] = link + host
+                print(f"  {'packbits' if compress else 'raw':8s} {reports:5d} reports  link {link * 1000:8.1f} ms  "
+                      f"host {host * 1000:6.1f} ms  total {(link + host) * 1000:8.1f} ms")
+            print(f"  speedup: {results[False] / results[True]:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup-time regression check. Imports the entry point, plus the modules a "no changes" run needs to fetch and
+compare events, under `python -X importtime` in a fresh interpreter. Fails if the cumulative import time exceeds the
+budget, or if anything only needed for rendering or uploading gets imported up front.
+
+Usage: python3 benchmarks/startup_budget.py [--budget-ms 1500] [--repeat 3]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# What a run that finds no changes has to import
+NO_CHANGE_IMPORTS = "import maginkcal, fetch_engine.fetch, ical_engine.ical"
+
+# Modules that must stay off the no-changes path
+FORBIDDEN = ["icalevents", "icalendar", "epd_hidapi", "render_engine.render", "render_engine.raster",
+             "PIL", "numpy", "hid"]
+
+
+def measure():
+    # Returns ({module: cumulative microseconds}, total microseconds) for a fresh interpreter
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", NO_CHANGE_IMPORTS],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    modules = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        modules[name.strip()] = int(cumulative)
+        # Top-level imports aren't indented; their cumulative times add up to the total
+        if not line.split("|")[2].startswith("  "):
+            total += int(cumulative)
+    return modules, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=1500,
+                        help="maximum cumulative import time (default sized for a Pi Zero)")
+    parser.add_argument("--repeat", type=int, default=3, help="take the best of this many runs")
+    args = parser.parse_args()
+
+    best_total = None
+    modules = {}
+    for _ in range(args.repeat):
+        modules, total = measure()
+        best_total = total if best_total is None else min(best_total, total)
+
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:10]
+    print("slowest imports (cumulative):")
+    for name, cumulative in slowest:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    loaded = [name for name in FORBIDDEN if any(m == name or m.startswith(name + ".") for m in modules)]
+    if loaded:
+        print(f"FAIL: imported on the no-changes path: {', '.join(loaded)}")
+        failed = True
+
+    print(f"total import time: {best_total / 1000:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    if best_total / 1000 > args.budget_ms:
+        print("FAIL: startup import time over budget")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
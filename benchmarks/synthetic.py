@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic calendar data for the benchmarks. A scenario describes a calendar load (event count, and how many events
+recur, span several days or last all day); it is turned into a reproducible list of event specs, which can be
+written out as an ICS feed or served as Google Calendar API responses through a stub service.
+"""
+
+import datetime as dt
+import random
+from collections import namedtuple
+
+Scenario = namedtuple("Scenario", ["name", "events", "calendars", "recurring", "multiday", "allday", "seed"])
+
+SCENARIOS = {
+    "small": Scenario("small", events=60, calendars=2, recurring=0.1, multiday=0.05, allday=0.1, seed=1),
+    "medium": Scenario("medium", events=400, calendars=3, recurring=0.2, multiday=0.1, allday=0.15, seed=2),
+    "large": Scenario("large", events=1500, calendars=4, recurring=0.35, multiday=0.15, allday=0.2, seed=3),
+}
+
+# Events are spread over a year of history before the window and a couple of weeks after it, like a real feed
+HISTORY_DAYS = 365
+FUTURE_DAYS = 14
+
+# Page size of the stub events().list, the Calendar API's default
+PAGE_SIZE = 250
+
+
+def generate_events(scenario, window_start, window_days=35, now=None):
+    # Reproducible event specs: dicts with uid, calendar (index), summary, allday, start, end (datetimes in UTC, or
+    # dates for all-day events, end exclusive), updated, and interval/count for recurring events
+    rng = random.Random(scenario.seed)
+    now = now or dt.datetime.combine(window_start, dt.time(12), tzinfo=dt.timezone.utc)
+    specs = []
+    for i in range(scenario.events):
+        day = window_start + dt.timedelta(days=rng.randrange(-HISTORY_DAYS, window_days + FUTURE_DAYS))
+        recurring = rng.random() < scenario.recurring
+        if recurring:
+            # Recurring series mostly start in the past and run into the window
+            day = window_start - dt.timedelta(days=rng.randrange(0, 120))
+        span = rng.randint(2, 5) if rng.random() < scenario.multiday else 1
+        allday = rng.random() < scenario.allday
+
+        if allday:
+            start = day
+            end = day + dt.timedelta(days=span)
+        else:
+            start = dt.datetime.combine(day, dt.time(rng.randint(7, 20), rng.choice([0, 15, 30, 45])),
+                                        tzinfo=dt.timezone.utc)
+            if span > 1:
+                end = start + dt.timedelta(days=span - 1, hours=rng.randint(1, 3))
+            else:
+                end = start + dt.timedelta(minutes=rng.choice([30, 60, 90, 120, 180]))
+
+        specs.append({
+            "uid": f"event-{scenario.seed}-{i}@maginkcal.test",
+            "calendar": i % scenario.calendars,
+            "summary": f"Synthetic event {i}",
+            "allday": allday,
+            "start": start,
+            "end": end,
+            # A few events count as recently updated, so the highlight path is exercised too
+            "updated": now - dt.timedelta(hours=rng.choice([2, 12, 200, 2000])),
+            "interval": rng.choice([1, 7, 7, 14]) if recurring else None,
+            "count": rng.randint(10, 60) if recurring else None,
+        })
+    return specs
+
+
+def ics_value(value):
+    if isinstance(value, dt.datetime):
+        return f":{value.strftime('%Y%m%dT%H%M%SZ')}"
+    return f";VALUE=DATE:{value.strftime('%Y%m%d')}"
+
+
+def ics_feed(specs):
+    # One VCALENDAR with every spec as a VEVENT (times in UTC, so no VTIMEZONE is needed)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//MagInkCal//Synthetic//EN"]
+    for spec in specs:
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{spec['uid']}",
+            f"DTSTAMP:{spec['updated'].strftime('%Y%m%dT%H%M%SZ')}",
+            f"LAST-MODIFIED:{spec['updated'].strftime('%Y%m%dT%H%M%SZ')}",
+            f"DTSTART{ics_value(spec['start'])}",
+            f"DTEND{ics_value(spec['end'])}",
+            f"SUMMARY:{spec['summary']}",
+        ]
+        if spec["interval"]:
+            lines.append(f"RRULE:FREQ=DAILY;INTERVAL={spec['interval']};COUNT={spec['count']}")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def gcal_time(value):
+    if isinstance(value, dt.datetime):
+        return {"dateTime": value.isoformat().replace("+00:00", "Z")}
+    return {"date": value.isoformat()}
+
+
+def gcal_items(specs):
+    # Events as the Calendar API returns them with singleEvents=True: recurring series expanded into instances
+    items = []
+    for spec in specs:
+        occurrences = spec["count"] or 1
+        for n in range(occurrences):
+            offset = dt.timedelta(days=n * (spec["interval"] or 0))
+            items.append({
+                "id": f"{spec['uid']}_{n}",
+                "status": "confirmed",
+                "summary": spec["summary"],
+                "start": gcal_time(spec["start"] + offset),
+                "end": gcal_time(spec["end"] + offset),
+                "updated": spec["updated"].isoformat().replace("+00:00", "Z"),
+            })
+    return items
+
+
+def item_bounds(item):
+    # (start, end) of an API item as aware datetimes, for window filtering
+    def parse(value):
+        if "dateTime" in value:
+            return dt.datetime.fromisoformat(value["dateTime"].replace("Z", "+00:00"))
+        return dt.datetime.combine(dt.date.fromisoformat(value["date"]), dt.time(), tzinfo=dt.timezone.utc)
+    return parse(item["start"]), parse(item["end"])
+
+
+class StubRequest:
+    def __init__(self, service, kwargs):
+        self.service = service
+        self.kwargs = kwargs
+
+    def execute(self, http=None):
+        return self.service.page(**self.kwargs)
+
+
+class StubEvents:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        return StubRequest(self.service, kwargs)
+
+    def list_next(self, request, response):
+        if not response.get("nextPageToken"):
+            return None
+        return StubRequest(self.service, dict(request.kwargs, pageToken=response["nextPageToken"]))
+
+
+class StubBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            self.callback(request_id, request.execute(), None)
+
+
+class StubCalendarService:
+    # Stands in for the googleapiclient Calendar service: events().list/list_next and batch requests, served from
+    # {calendarId: [items]} with window filtering, start ordering and pagination like the real API
+
+    def __init__(self, items_by_calendar):
+        self.items_by_calendar = {
+            cal_id: sorted(items, key=lambda item: item_bounds(item)[0])
+            for cal_id, items in items_by_calendar.items()
+        }
+
+    def events(self):
+        return StubEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return StubBatch(callback)
+
+    def page(self, calendarId, timeMin=None, timeMax=None, pageToken=None, **kwargs):
+        items = self.items_by_calendar.get(calendarId, [])
+        if timeMin and timeMax:
+            low = dt.datetime.fromisoformat(timeMin)
+            high = dt.datetime.fromisoformat(timeMax)
+            items = [item for item in items if item_bounds(item)[0] <= high and item_bounds(item)[1] >= low]
+
+        offset = int(pageToken or 0)
+        response = {"items": items[offset:offset + PAGE_SIZE]}
+        if offset + PAGE_SIZE < len(items):
+            response["nextPageToken"] = str(offset + PAGE_SIZE)
+        else:
+            response["nextSyncToken"] = "synthetic"
+        return response
+
+
+if __name__ == "__main__":
+    window_start = dt.date(2024, 9, 1)
+    for scenario in SCENARIOS.values():
+        specs = generate_events(scenario, window_start)
+        print(f"{scenario.name}: {len(specs)} events, {len(ics_feed(specs))} bytes of ICS, "
+              f"{len(gcal_items(specs))} API items")
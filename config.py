@@ -5,8 +5,7 @@ class Config:
     def __init__(self, config_file=None):
         self._path = str(pathlib.Path(__file__).parent.absolute())
 
-        if not config_file:
-            self.config_file = f"{self._path}/config.json"
+        self.config_file = config_file or f"{self._path}/config.json"
 
         # Load the configuration and store each key as a class variable
         with open(self.config_file) as fo:
@@ -19,7 +18,8 @@ class Config:
         return '\n'.join([v for v in vars(self)])
 
     def get(self, key, value=None):
-        return getattr(self, key, value)
+        # __getattr__ swallows missing keys, so look in the instance dict for the default to apply
+        return vars(self).get(key, value)
 
     def __getattr__( self, name):
         return None
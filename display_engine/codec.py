@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compressed, chunked bitplane transfer. Calendar frames are mostly white, so each plane is PackBits (run-length)
+encoded on the host and streamed in HID-report-sized chunks, with a window of reports in flight instead of waiting
+on the device after each one.
+
+Stream format (every report is REPORT_SIZE bytes, zero padded):
+    start report:  b"S", plane (0 black, 1 red), codec (0 raw, 1 PackBits), raw length, payload length and CRC32 of
+                   the raw plane (little-endian uint32s)
+    data reports:  sequence number (mod 256), then REPORT_SIZE - 1 bytes of payload
+    device acks:   b"A", sequence number of the last report received, status (0 ok), sent every ack_every reports
+                   and after the last one, once the plane has been decoded and checked
+
+This needs panel (firmware) support, exposed as panel.write_report/panel.read_report; without it the existing
+upload_image path is used.
+"""
+
+import logging
+import re
+import struct
+import zlib
+
+REPORT_SIZE = 64
+PAYLOAD_SIZE = REPORT_SIZE - 1
+
+CODEC_RAW = 0
+CODEC_PACKBITS = 1
+
+START = struct.Struct("<cBBIII")
+ACK = struct.Struct("<cBB")
+
+# Runs of at least this many identical bytes are worth a repeat header; shorter ones stay in the literal stream
+MIN_RUN = 3
+
+# Maximal runs of identical bytes, found by the regex engine rather than a Python loop over every byte
+RUNS = re.compile(rb"(.)\1*", re.DOTALL)
+
+
+def packbits_encode(data):
+    # PackBits: header n in 0..127 is followed by n + 1 literal bytes; header 257 - n (129..255) by one byte that
+    # repeats n times (2..128)
+    out = bytearray()
+    literal_start = None
+
+    def flush_literals(start, end):
+        for i in range(start, end, 128):
+            chunk = data[i:min(i + 128, end)]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+
+    for run in RUNS.finditer(data):
+        length = run.end() - run.start()
+        if length < MIN_RUN:
+            if literal_start is None:
+                literal_start = run.start()
+            continue
+
+        if literal_start is not None:
+            flush_literals(literal_start, run.start())
+            literal_start = None
+        value = data[run.start()]
+        while length > 0:
+            count = min(length, 128)
+            if count < 2:
+                # A single leftover byte of a long run is a one byte literal
+                out.extend((0, value))
+            else:
+                out.extend((257 - count, value))
+            length -= count
+
+    if literal_start is not None:
+        flush_literals(literal_start, len(data))
+    return bytes(out)
+
+
+def packbits_decode(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        header = data[i]
+        i += 1
+        if header < 128:
+            out.extend(data[i:i + header + 1])
+            i += header + 1
+        elif header > 128:
+            out.extend(data[i:i + 1] * (257 - header))
+            i += 1
+        # 128 is a no-op
+    return bytes(out)
+
+
+class StreamUploader:
+
+    def __init__(self, panel, compress=True, window=16, ack_every=4, ack_timeout_ms=1000):
+        self.logger = logging.getLogger(__name__)
+        self.panel = panel
+        self.compress = compress
+        # Reports that may be sent before an acknowledgement comes back; must be a multiple of ack_every
+        self.window = window
+        self.ack_every = ack_every
+        self.ack_timeout_ms = ack_timeout_ms
+
+    def supported(self):
+        return hasattr(self.panel, "write_report") and hasattr(self.panel, "read_report")
+
+    def read_ack(self):
+        report = self.panel.read_report(self.ack_timeout_ms)
+        if not report:
+            raise TimeoutError("Panel did not acknowledge the transfer")
+        kind, seq, status = ACK.unpack(bytes(report[:ACK.size]))
+        if kind != b"A":
+            raise IOError(f"Unexpected report from the panel: {bytes(report[:8])!r}")
+        if status != 0:
+            raise IOError(f"Panel rejected the transfer (status {status})")
+        return seq
+
+    def send_plane(self, plane, data):
+        # Stream one plane; returns the number of bytes written to the device
+        data = bytes(data)
+        codec, payload = CODEC_RAW, data
+        if self.compress:
+            encoded = packbits_encode(data)
+            # Noise (e.g. a photo) can come out slightly larger; send those planes as they are
+            if len(encoded) < len(data):
+                codec, payload = CODEC_PACKBITS, encoded
+        start = START.pack(b"S", plane, codec, len(data), len(payload), zlib.crc32(data))
+        self.panel.write_report(start.ljust(REPORT_SIZE, b"\0"))
+
+        reports = [payload[i:i + PAYLOAD_SIZE] for i in range(0, len(payload), PAYLOAD_SIZE)]
+        unacked = 0
+        for seq, chunk in enumerate(reports):
+            if unacked >= self.window:
+                # The device acks every ack_every reports, so one ack frees that many slots
+                self.read_ack()
+                unacked -= self.ack_every
+            self.panel.write_report((bytes([seq % 256]) + chunk).ljust(REPORT_SIZE, b"\0"))
+            unacked += 1
+
+        # Drain the outstanding acks; the last one also confirms the decoded plane passed its CRC check
+        outstanding = (unacked + self.ack_every - 1) // self.ack_every
+        for _ in range(outstanding):
+            self.read_ack()
+        return REPORT_SIZE * (len(reports) + 1)
+
+    def upload(self, black, red):
+        sent = self.send_plane(0, black) + self.send_plane(1, red)
+        raw = len(black) + len(red) + 2 * REPORT_SIZE
+        self.logger.info(f"Streamed {sent} bytes for {raw} bytes of planes ({sent / raw:.0%})")
+        return sent
+
+
+class StreamingPanel:
+    # Wraps a Panel so that full uploads are streamed compressed when the firmware supports it; everything else
+    # (partial uploads included) goes straight to the wrapped panel
+
+    def __init__(self, panel, **kwargs):
+        self.panel = panel
+        self.uploader = StreamUploader(panel, **kwargs)
+        # Bytes written to the device by the last streamed upload (None if nothing was streamed)
+        self.sent = None
+
+    def upload_image(self, black, red):
+        if not self.uploader.supported():
+            return self.panel.upload_image(black, red)
+        self.sent = self.uploader.upload(black, red)
+
+    def __getattr__(self, name):
+        return getattr(self.panel, name)
+
+
+if __name__ == "__main__":
+    import os
+
+    # Round trip on structured and random data, including runs longer than 128 and runs at the edges
+    samples = [
+        b"",
+        b"\x00",
+        b"\xff" * 1000,
+        b"ab" * 300,
+        b"\x00" * 129 + b"xyz" + b"\x00" * 2 + b"q" * 3,
+        bytes(range(256)) * 3,
+        os.urandom(10000),
+        b"\x00" * 5000 + os.urandom(300) + b"\xaa" * 700,
+    ]
+    for sample in samples:
+        encoded = packbits_encode(sample)
+        assert packbits_decode(encoded) == sample, sample[:16]
+        print(f"{len(sample):6d} -> {len(encoded):6d} bytes")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NumPy implementation of the screenshot -> bitplane stage. Mirrors the interface of epd_hidapi's Image (resize,
+rotate, quantize, extract, bit_array_black/bit_array_red) but keeps the frame as an array end to end: dithering and
+the black/red separation are vectorized, and the planes come out packed (np.packbits) ready for HID transfer.
+
+The interface matches, the pixels do not: resizing is nearest-neighbor, quantization uses its own palette matching
+and dithering is ordered (8x8 Bayer), so the planes can differ from epd_hidapi's for the same screenshot. This has not
+been checked against epd_hidapi or a frame captured from the panel, which is why the pipeline is only used when
+imagePipeline is set to "numpy".
+"""
+
+import numpy as np
+from PIL import Image as PILImage
+
+# Colors the panel can show, in palette order
+PALETTE = np.array([[255, 255, 255], [0, 0, 0], [255, 0, 0]], dtype=np.int32)
+
+# 8x8 Bayer matrix, normalized to (-0.5, 0.5). Ordered dithering only looks at a pixel's own position, so unlike
+# error diffusion it can be applied to the whole frame at once.
+BAYER_8 = np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+], dtype=np.float32) / 64 - 0.5
+
+
+class ImagePipeline:
+
+    def __init__(self, infile=None, array=None, dither_strength=96):
+        # Accepts either an image file (like epd_hidapi's Image) or an RGB array already in memory
+        if array is None:
+            with PILImage.open(infile) as image:
+                array = np.asarray(image.convert("RGB"))
+        self.array = np.ascontiguousarray(array[:, :, :3], dtype=np.uint8)
+        self.dither_strength = dither_strength
+        self.bit_array_black = None
+        self.bit_array_red = None
+
+    def resize(self, width, height):
+        # Screenshots are normally already at panel resolution, so this is usually a no-op
+        h, w = self.array.shape[:2]
+        if (w, h) == (width, height):
+            return
+        # Nearest-neighbor sampling via index arrays
+        rows = (np.arange(height) * h // height)
+        cols = (np.arange(width) * w // width)
+        self.array = self.array[rows[:, None], cols[None, :]]
+
+    def rotate(self, rotation=90):
+        # Counter-clockwise, in multiples of 90 degrees (same direction as PIL's Image.rotate)
+        self.array = np.ascontiguousarray(np.rot90(self.array, k=(rotation // 90) % 4))
+
+    def quantize(self, dither=True):
+        # Map every pixel to the nearest palette color, optionally with ordered dithering
+        pixels = self.array.astype(np.int32)
+        if dither:
+            h, w = pixels.shape[:2]
+            threshold = np.tile(BAYER_8, (h // 8 + 1, w // 8 + 1))[:h, :w]
+            pixels = pixels + (threshold * self.dither_strength).astype(np.int32)[:, :, None]
+
+        # Squared distance to each palette entry: (3 colors, h, w); ties go to the earlier palette entry
+        distances = np.stack([((pixels - color) ** 2).sum(axis=2) for color in PALETTE])
+        self.array = PALETTE[distances.argmin(axis=0)].astype(np.uint8)
+
+    def extract(self, threshold=200):
+        # Split into black and red planes (1 = ink) and pack 8 pixels per byte, row by row, MSB first
+        r, g, b = self.array[:, :, 0], self.array[:, :, 1], self.array[:, :, 2]
+        dark_gb = (g < threshold) & (b < threshold)
+        black = dark_gb & (r < threshold)
+        red = dark_gb & (r >= threshold)
+        self.bit_array_black = np.packbits(black, axis=1).tobytes()
+        self.bit_array_red = np.packbits(red, axis=1).tobytes()
+
+    def save(self, outfile):
+        PILImage.fromarray(self.array).save(outfile)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Differential panel updates. The last uploaded black/red bitplanes are kept on disk; each new frame is compared with
+them and, when only a small part of the screen changed, only the dirty windows are sent to the panel. A full upload
+is still forced periodically to clear ghosting.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import datetime as dt
+import json
+import logging
+import pathlib
+
+from atomic import write_atomic
+
+
+class PartialUpdateHelper:
+
+    def __init__(self, width, height, max_partials=10, max_hours=24, max_area_ratio=0.3, merge_rows=8,
+                 state_dir=None):
+        self.logger = logging.getLogger(__name__)
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.state_dir = state_dir or self.currPath
+        # Bitplanes are packed 1 bit per pixel, row by row
+        self.width = width
+        self.height = height
+        self.stride = width // 8
+        self.max_partials = max_partials
+        self.max_hours = max_hours
+        self.max_area_ratio = max_area_ratio
+        self.merge_rows = merge_rows
+
+    def load(self):
+        # Returns (meta, black, red) of the last uploaded frame, or (None, None, None) if there isn't a usable one
+        try:
+            with open(f"{self.state_dir}/last_frame.json", "r") as fo:
+                meta = json.load(fo)
+            with open(f"{self.state_dir}/last_frame.bin", "rb") as fo:
+                planes = fo.read()
+        except (FileNotFoundError, ValueError):
+            return None, None, None
+
+        size = self.stride * self.height
+        if meta.get("width") != self.width or meta.get("height") != self.height or len(planes) != 2 * size:
+            return None, None, None
+        return meta, planes[:size], planes[size:]
+
+    def save(self, black, red, partials, last_full):
+        write_atomic(f"{self.state_dir}/last_frame.bin", black + red)
+        write_atomic(f"{self.state_dir}/last_frame.json", json.dumps({
+            "width": self.width,
+            "height": self.height,
+            "partials": partials,
+            "lastFull": last_full,
+        }).encode("utf-8"))
+
+    def dirty_rects(self, old_black, old_red, black, red):
+        # Bounding rectangles (x, y, width, height in pixels) around the changed rows of either plane. Adjacent
+        # dirty rows, and bands separated by fewer than merge_rows clean rows, share one rectangle.
+        rects = []
+        band = None
+        for y in range(self.height):
+            row = slice(y * self.stride, (y + 1) * self.stride)
+            if old_black[row] == black[row] and old_red[row] == red[row]:
+                continue
+
+            # Narrow the row down to the first and last changed byte
+            cols = [x for x in range(self.stride)
+                    if old_black[row.start + x] != black[row.start + x] or old_red[row.start + x] != red[row.start + x]]
+            first, last = cols[0], cols[-1]
+
+            if band and y - band[3] <= self.merge_rows:
+                band = [min(band[0], first), band[1], max(band[2], last), y]
+            else:
+                if band:
+                    rects.append(band)
+                band = [first, y, last, y]
+        if band:
+            rects.append(band)
+
+        return [(x0 * 8, y0, (x1 - x0 + 1) * 8, y1 - y0 + 1) for x0, y0, x1, y1 in rects]
+
+    def window(self, plane, rect):
+        # Cut a rectangle (byte aligned horizontally) out of a packed bitplane
+        x, y, width, height = rect
+        start = x // 8
+        return b"".join(plane[(row * self.stride) + start:(row * self.stride) + start + width // 8]
+                        for row in range(y, y + height))
+
+    def plan(self, black, red, now=None):
+        # Decide between a full upload (returns None) and a list of dirty rectangles (possibly empty)
+        now = now or dt.datetime.now()
+        meta, old_black, old_red = self.load()
+        if meta is None:
+            self.logger.info("No previous frame; full refresh")
+            return None
+
+        if meta.get("partials", 0) >= self.max_partials:
+            self.logger.info(f"{meta['partials']} partial updates since the last full refresh; full refresh")
+            return None
+
+        last_full = dt.datetime.fromisoformat(meta["lastFull"]) if meta.get("lastFull") else None
+        if last_full is None or (now - last_full).total_seconds() >= self.max_hours * 3600:
+            self.logger.info("Scheduled full refresh")
+            return None
+
+        rects = self.dirty_rects(old_black, old_red, black, red)
+        area = sum(width * height for _, _, width, height in rects)
+        if area > self.max_area_ratio * self.width * self.height:
+            self.logger.info(f"{area} dirty pixels; full refresh")
+            return None
+
+        return rects
+
+    def upload(self, panel, black, red, now=None):
+        # Returns the number of plane bytes sent to the panel
+        now = now or dt.datetime.now()
+        black = bytes(black)
+        red = bytes(red)
+        meta, _, _ = self.load()
+        rects = self.plan(black, red, now)
+
+        # Partial windows need panel (firmware) support; fall back to a full upload without it
+        upload_partial = getattr(panel, "upload_partial_image", None)
+        if rects is not None and upload_partial is None:
+            self.logger.info("Panel does not support partial updates; full refresh")
+            rects = None
+
+        if rects is None:
+            panel.upload_image(black, red)
+            self.save(black, red, 0, now.isoformat())
+            return len(black) + len(red)
+
+        sent = 0
+        for rect in rects:
+            self.logger.info(f"Partial update of {rect}")
+            window_black, window_red = self.window(black, rect), self.window(red, rect)
+            upload_partial(window_black, window_red, *rect)
+            sent += len(window_black) + len(window_red)
+        self.save(black, red, meta.get("partials", 0) + 1, meta.get("lastFull"))
+        return sent
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    class FakePanel:
+        def upload_image(self, black, red):
+            print(f"full upload of {len(black) + len(red)} bytes")
+
+        def upload_partial_image(self, black, red, x, y, width, height):
+            print(f"partial upload of {len(black) + len(red)} bytes at {(x, y, width, height)}")
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        helper = PartialUpdateHelper(width=768, height=960, state_dir=state_dir)
+        black = bytearray(helper.stride * helper.height)
+        red = bytearray(helper.stride * helper.height)
+        helper.upload(FakePanel(), black, red)
+
+        # Edit one "day cell"
+        for y in range(400, 420):
+            black[y * helper.stride + 20:y * helper.stride + 30] = b"\xff" * 10
+        helper.upload(FakePanel(), black, red)
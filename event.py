@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The event model shared by the calendar engines and the renderer. Both GcalHelper and IcalHelper emit Event objects
+holding only what the calendar view needs, so everything downstream (fingerprinting, caching, rendering) relies on a
+single schema. Events are immutable: normalization steps return updated copies (dataclasses.replace).
+"""
+
+import datetime as dt
+from dataclasses import dataclass, replace
+
+
+@dataclass(frozen=True)
+class Event:
+    # Slots instead of a per-instance __dict__: a fraction of the memory of the dicts the engines used to return
+    __slots__ = ("summary", "allday", "startDatetime", "endDatetime", "isUpdated", "isMultiday", "updatedDatetime",
+                 "uid")
+
+    summary: str
+    allday: bool
+    startDatetime: dt.datetime
+    endDatetime: dt.datetime
+    isUpdated: bool
+    isMultiday: bool
+    # Not rendered: used to re-evaluate isUpdated and to de-duplicate occurrences of the same event
+    updatedDatetime: dt.datetime
+    uid: str
+
+    def __reduce__(self):
+        # Pickle as the class plus a tuple of values instead of a dict of field names
+        return Event, (self.summary, self.allday, self.startDatetime, self.endDatetime, self.isUpdated,
+                       self.isMultiday, self.updatedDatetime, self.uid)
+
+    def with_recent_update(self, thresholdHours, now=None):
+        # Copy with isUpdated re-evaluated: events updated within the past thresholdHours count as recently updated
+        if self.updatedDatetime is None:
+            return self
+        now = now or dt.datetime.now(dt.timezone.utc)
+        isUpdated = (now - self.updatedDatetime).total_seconds() / 3600 < thresholdHours
+        return self if isUpdated == self.isUpdated else replace(self, isUpdated=isUpdated)
+
+
+if __name__ == "__main__":
+    import pickle
+    import sys
+
+    start = dt.datetime(2024, 9, 2, 8, tzinfo=dt.timezone.utc)
+    event = Event(summary="Test", allday=False, startDatetime=start, endDatetime=start + dt.timedelta(hours=1),
+                  isUpdated=False, isMultiday=False, updatedDatetime=start, uid="test@maginkcal")
+    as_dict = {name: getattr(event, name) for name in Event.__slots__}
+
+    print(f"pickle: {len(pickle.dumps([event]))} bytes (dict: {len(pickle.dumps([as_dict]))} bytes)")
+    print(f"size: {sys.getsizeof(event)} bytes (dict: {sys.getsizeof(as_dict)} bytes)")
+    print(pickle.loads(pickle.dumps(event)) == event, hash(event) == hash(replace(event)))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Circuit breaker for calendar sources. After a number of consecutive failures a source is left alone for a backoff
+period that doubles with every further failure (up to a maximum), instead of costing every run a timeout. Once the
+backoff has passed the source gets one attempt again; a success closes the breaker. The state is persisted, so it
+also holds across the runs of a timer-driven setup.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import datetime as dt
+import hashlib
+import json
+import logging
+import pathlib
+import threading
+
+from atomic import write_atomic
+
+
+class CircuitBreaker:
+
+    def __init__(self, state_path=None, threshold=3, backoff=300, max_backoff=6 * 3600):
+        self.logger = logging.getLogger(__name__)
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.state_path = state_path or f"{self.currPath}/state/breaker.json"
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Fetch tasks report their outcome from worker threads
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+
+    def key(self, cal_id):
+        return hashlib.sha1(cal_id.encode("utf-8")).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.state_path, "r") as fo:
+                return json.load(fo)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self, state):
+        write_atomic(self.state_path, json.dumps(state))
+
+    def allow(self, cal_id, now=None):
+        # Whether the source may be fetched now: its breaker is closed, or its backoff has passed
+        now = now or dt.datetime.now(dt.timezone.utc)
+        with self.lock:
+            entry = self.load().get(self.key(cal_id))
+        if not entry or not entry.get("openUntil"):
+            return True
+        return now >= dt.datetime.fromisoformat(entry["openUntil"])
+
+    def record_success(self, cal_id):
+        with self.lock:
+            state = self.load()
+            if state.pop(self.key(cal_id), None) is not None:
+                self.logger.info(f"{cal_id} recovered; closing breaker")
+                self.save(state)
+
+    def record_failure(self, cal_id, now=None):
+        now = now or dt.datetime.now(dt.timezone.utc)
+        with self.lock:
+            state = self.load()
+            entry = state.setdefault(self.key(cal_id), {"failures": 0, "openUntil": None})
+            entry["failures"] += 1
+            if entry["failures"] >= self.threshold:
+                backoff = min(self.max_backoff, self.backoff * 2 ** (entry["failures"] - self.threshold))
+                entry["openUntil"] = (now + dt.timedelta(seconds=backoff)).isoformat()
+                self.logger.warning(f"{cal_id} failed {entry['failures']} times in a row; "
+                                    f"backing off for {backoff:.0f}s")
+            self.save(state)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        breaker = CircuitBreaker(f"{state_dir}/breaker.json", threshold=2, backoff=60)
+        now = dt.datetime.now(dt.timezone.utc)
+        for _ in range(3):
+            breaker.record_failure("https://example.com/feed.ics", now)
+            print(breaker.allow("https://example.com/feed.ics", now))  # True, False, False
+        print(breaker.allow("https://example.com/feed.ics", now + dt.timedelta(seconds=121)))  # True
+        breaker.record_success("https://example.com/feed.ics")
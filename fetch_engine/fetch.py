@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is where events from every configured calendar are retrieved. Each calendar, regardless of its type, is
+fetched on a bounded thread pool so the fetch phase takes roughly as long as the slowest calendar instead of the
+sum of all of them. With a deadline, it takes no longer than that: calendars that miss it, fail, or are backing off
+after repeated failures are rendered from their last good events (or left empty if there are none), while late
+fetches finish in the background and refresh those for the next run.
+"""
+
+import datetime as dt
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from fetch_engine.breaker import CircuitBreaker
+from fetch_engine.last_good import LastGoodStore
+from metrics import Metrics
+
+
+class FetchHelper:
+
+    def __init__(self, calendars, max_workers=4, timeout=30, gcal_incremental_sync=False, gcal_batch=False,
+                 ical_prune=False, metrics=None, deadline=None, breaker_threshold=3, breaker_backoff=300,
+                 breaker_max_backoff=6 * 3600, state_dir=None, ical_process_workers=0,
+                 ical_process_threshold=256 * 1024):
+        self.logger = logging.getLogger(__name__)
+        self.calendars = calendars
+        self.metrics = metrics or Metrics()
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.deadline = deadline
+        self.last_good = LastGoodStore(state_dir)
+        self.breaker = CircuitBreaker(f"{state_dir}/breaker.json" if state_dir else None, threshold=breaker_threshold,
+                                      backoff=breaker_backoff, max_backoff=breaker_max_backoff)
+        # Calendars whose fetch is still running (possibly from an earlier run that moved on without it)
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.gcal_batch = gcal_batch
+        self.gcalService = None
+        self.icalService = None
+
+        gcal_calendars = [cal for cal in calendars if cal.get("type") == "gcal"]
+        self.logger.info("gcal_calendars: " + str(gcal_calendars))
+        if gcal_calendars:
+            # Use lazy imports so that gcal credentials aren't required if not using a google calendar
+            from gcal_engine.gcal import GcalHelper
+            self.gcalService = GcalHelper(timeout=timeout, incremental_sync=gcal_incremental_sync,
+                                         metrics=self.metrics)
+
+        ical_calendars = [cal for cal in calendars if cal.get("type") == "ical"]
+        self.logger.info("ical_calendars: " + str(ical_calendars))
+        if ical_calendars:
+            from ical_engine.ical import IcalHelper
+            self.icalService = IcalHelper(ical_calendars, timeout=timeout, prune=ical_prune,
+                                         metrics=self.metrics, process_workers=ical_process_workers,
+                                         process_threshold=ical_process_threshold)
+
+    def close(self):
+        if self.icalService:
+            self.icalService.close()
+
+    def get_service(self, cal):
+        if cal.get("type") == "gcal":
+            return self.gcalService
+        elif cal.get("type") == "ical":
+            return self.icalService
+        return None
+
+    def retrieve_single(self, calendars, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Same shape as GcalHelper.retrieve_batch: one list of events per calendar
+        return [self.get_service(cal).retrieve_calendar_events(
+            cal, startDatetime, endDatetime, localTZ, thresholdHours) for cal in calendars]
+
+    def calendar_label(self, cal):
+        # How a calendar appears in the metrics. iCal ids are (often secret) feed URLs, so an unnamed calendar is
+        # labelled with a short hash of its id instead
+        if cal.get("summary"):
+            return cal["summary"]
+        return "calendar-" + hashlib.sha1(cal["id"].encode("utf-8")).hexdigest()[:8]
+
+    def run_task(self, stages, fn, group, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Each task is one fetch stage of the run it was started for, labelled with the calendar(s) it covers. Returns
+        # one entry per calendar (its events or the exception it failed with) and records the outcome, even if the run
+        # stopped waiting for it.
+        label = ", ".join(self.calendar_label(cal) for cal in group)
+        try:
+            with self.metrics.bind(stages), self.metrics.stage("fetch", calendar=label):
+                results = fn(group, startDatetime, endDatetime, localTZ, thresholdHours)
+        except Exception as e:
+            results = [e] * len(group)
+
+        for cal, events in zip(group, results):
+            try:
+                if isinstance(events, Exception):
+                    self.logger.error(f"Failed to retrieve {cal['id']}: {events}")
+                    self.breaker.record_failure(cal["id"])
+                else:
+                    self.last_good.save(cal["id"], events)
+                    self.breaker.record_success(cal["id"])
+            except OSError as e:
+                self.logger.warning(f"Could not record the fetch of {cal['id']}: {e}")
+            finally:
+                with self.lock:
+                    self.in_flight.discard(cal["id"])
+        return results
+
+    def fallback(self, cal, error, startDatetime, endDatetime, thresholdHours):
+        # The last good events of a calendar that has no fresh ones this run, or none if there aren't any: one
+        # calendar that is down shouldn't keep the others from being shown
+        with self.metrics.stage("fallback", calendar=self.calendar_label(cal)) as stage:
+            events, saved = self.last_good.load(cal["id"], startDatetime, endDatetime)
+            if events is None:
+                # Counted as an error of the stage, the calendar is left empty
+                stage["error"] = type(error).__name__
+                self.logger.error(f"No events of {cal['id']} to show: {error}")
+                return []
+        self.logger.warning(f"Using events of {cal['id']} from {saved.isoformat()} ({error})")
+
+        # The 'recently updated' highlight depends on the current time, so it is re-evaluated
+        utcnow = dt.datetime.now(dt.timezone.utc)
+        return [event.with_recent_update(thresholdHours, utcnow) for event in events]
+
+    def build_tasks(self, calendars):
+        # Batched gcal calendars share a single task (and HTTP exchange); every other calendar gets its own task
+        tasks = []
+        gcal_calendars = [cal for cal in calendars if cal.get("type") == "gcal"]
+        if self.gcal_batch and len(gcal_calendars) > 1:
+            tasks.append((gcal_calendars, self.gcalService.retrieve_batch))
+        else:
+            gcal_calendars = []
+
+        for cal in calendars:
+            if cal not in gcal_calendars:
+                tasks.append(([cal], self.retrieve_single))
+        return tasks
+
+    def retrieve_events(self, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Fan out across every calendar and return all events that fall within the specified dates
+        calendars = [cal for cal in self.calendars if self.get_service(cal)]
+        if not calendars:
+            return []
+
+        self.logger.info('Retrieving events between ' +
+                         startDatetime.isoformat() + ' and ' + endDatetime.isoformat() + '...')
+
+        # Calendars that are backing off, or whose fetch from an earlier run hasn't returned yet, aren't fetched again
+        with self.lock:
+            runnable = [cal for cal in calendars if cal["id"] not in self.in_flight and self.breaker.allow(cal["id"])]
+            self.in_flight.update(cal["id"] for cal in runnable)
+
+        results = {}
+        if runnable:
+            tasks = self.build_tasks(runnable)
+            executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(tasks)))
+            stages = self.metrics.stages
+            futures = [
+                (group, executor.submit(self.run_task, stages, fn, group, startDatetime, endDatetime, localTZ,
+                                        thresholdHours))
+                for group, fn in tasks
+            ]
+            done, _ = wait([future for _, future in futures], timeout=self.deadline)
+            # Don't wait for stragglers; they finish in the background and update the last good events. (The
+            # interpreter still joins these threads when it exits, so a oneshot run ends once they are done.)
+            executor.shutdown(wait=False)
+
+            for group, future in futures:
+                if future in done:
+                    for cal, events in zip(group, future.result()):
+                        results[id(cal)] = events
+
+        # Merge in configuration order (not completion order) so the merged list is deterministic
+        eventList = []
+        for cal in calendars:
+            events = results.get(id(cal))
+            if events is None:
+                if cal in runnable:
+                    events = TimeoutError(f"{cal['id']} missed the {self.deadline}s fetch deadline")
+                else:
+                    events = ConnectionError(f"{cal['id']} is backing off or still being fetched")
+            if isinstance(events, Exception):
+                events = self.fallback(cal, events, startDatetime, endDatetime, thresholdHours)
+            eventList.extend(events)
+
+        # Python's sort is stable, so events starting at the same time keep their configuration order
+        return sorted(eventList, key=lambda k: k.startDatetime)
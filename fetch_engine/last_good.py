@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Last good events of every calendar. Each successful fetch stores the calendar's normalized events, so a calendar that
+misses the fetch deadline, fails, or is backing off can still be rendered from the data it last returned.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import datetime as dt
+import hashlib
+import logging
+import pathlib
+import pickle
+
+from atomic import write_atomic
+
+# Bumped whenever the stored event type changes, so older entries are ignored instead of misread
+FORMAT = 2
+
+
+class LastGoodStore:
+
+    def __init__(self, state_dir=None):
+        self.logger = logging.getLogger(__name__)
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.state_dir = state_dir or f"{self.currPath}/state"
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def path_for(self, cal_id):
+        return f"{self.state_dir}/{hashlib.sha1(cal_id.encode('utf-8')).hexdigest()}.events.pickle"
+
+    def save(self, cal_id, events):
+        write_atomic(self.path_for(cal_id), pickle.dumps(
+            {"format": FORMAT, "calendarId": cal_id, "saved": dt.datetime.now(dt.timezone.utc), "events": events}))
+
+    def load(self, cal_id, startDatetime, endDatetime):
+        # Returns (events overlapping the window, when they were fetched), or (None, None) if nothing usable is stored
+        try:
+            with open(self.path_for(cal_id), "rb") as fo:
+                entry = pickle.load(fo)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None, None
+
+        if entry.get("format") != FORMAT or entry.get("calendarId") != cal_id:
+            return None, None
+
+        events = [event for event in entry["events"]
+                  if event.endDatetime >= startDatetime and event.startDatetime <= endDatetime]
+        return events, entry["saved"]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Change detection for the rendered view. Instead of keeping every event of the last run around, should_refresh compares
+a SHA-256 digest of the day and the render-relevant fields of the ordered events against the digest stored in
+last.json, so an update whose view hasn't changed can skip rendering and the panel refresh.
+"""
+
+import datetime as dt
+import hashlib
+import json
+import pathlib
+
+from atomic import write_atomic
+
+# Only these Event fields change what ends up on screen; uid and updatedDatetime are ignored
+RENDER_FIELDS = ("summary", "allday", "startDatetime", "endDatetime", "isUpdated", "isMultiday")
+
+
+def field_text(value):
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def event_digest(event):
+    # Stable content hash of the render-relevant fields of a single event
+    text = "\x1f".join(field_text(getattr(event, field)) for field in RENDER_FIELDS)
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def view_digest(event_list, today):
+    # Hash of everything should_refresh compares: the day and the ordered events
+    h = hashlib.sha256(field_text(today).encode("utf-8"))
+    for event in event_list:
+        h.update(event_digest(event))
+    return h.hexdigest()
+
+
+class FingerprintStore:
+    def __init__(self, path=None):
+        self._path = str(pathlib.Path(__file__).parent.absolute())
+        self.path = path or f"{self._path}/last.json"
+
+    def load(self):
+        try:
+            with open(self.path, "r") as fo:
+                return json.load(fo)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self, record):
+        write_atomic(self.path, json.dumps(record))
+
+
+if __name__ == "__main__":
+    from dataclasses import replace
+    from pytz import timezone
+    from event import Event
+
+    tz = timezone("America/Los_Angeles")
+    event = Event(summary="Test", allday=False, isUpdated=False, isMultiday=False,
+                  startDatetime=tz.localize(dt.datetime(2024, 9, 2, 8)),
+                  endDatetime=tz.localize(dt.datetime(2024, 9, 2, 9)),
+                  updatedDatetime=None, uid="ignored")
+    print(view_digest([event], dt.date(2024, 9, 2)))
+    print(view_digest([replace(event, uid="still ignored")], dt.date(2024, 9, 2)))
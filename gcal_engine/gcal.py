@@ -5,24 +5,69 @@ This is where we retrieve events from the Google Calendar. Before doing so, make
 credentials.json and token.pickle in the same folder as this file. If not, run quickstart.py first.
 """
 
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
 import datetime as dt
 import logging
 import os.path
 import pathlib
 import pickle
+import time
 
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from event import Event
+from gcal_engine.sync_store import SyncStore
+from metrics import Metrics
+
+# The Calendar API accepts at most 50 calls per batch request
+MAX_BATCH_SIZE = 50
+
+# Only request the attributes the renderer (and incremental sync) actually use
+EVENT_FIELDS = 'nextPageToken,nextSyncToken,items(id,etag,status,summary,start,end,updated)'
+
+
+class CountingHttp:
+    # Passes requests through to an authorized connection and counts the response bytes against the active stage
+
+    def __init__(self, http, metrics):
+        self.http = http
+        self.metrics = metrics
+
+    def request(self, *args, **kwargs):
+        response, content = self.http.request(*args, **kwargs)
+        self.metrics.add_bytes(len(content or b""))
+        return response, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
 
 
 class GcalHelper:
 
-    def __init__(self):
+    def __init__(self, timeout=30, incremental_sync=False, service=None, metrics=None):
         self.logger = logging.getLogger(__name__)
+        self.metrics = metrics or Metrics()
         # Initialise the Google Calendar using the provided credentials and token
         SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
         self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.timeout = timeout
+        self.sync_store = SyncStore() if incremental_sync else None
+
+        if service is not None:
+            # An already built (or fake) service skips the OAuth flow entirely
+            self.creds = None
+            self.service = service
+            return
 
         creds = None
         # The file token.pickle stores the user's access and refresh tokens, and is
@@ -43,6 +88,7 @@ class GcalHelper:
             with open(self.currPath + '/token.pickle', 'wb') as token:
                 pickle.dump(creds, token)
 
+        self.creds = creds
         self.service = build(
             'calendar', 'v3', credentials=creds, cache_discovery=False)
 
@@ -85,61 +131,255 @@ class GcalHelper:
         # check if event stretches across multiple days
         return start.date() != end.date()
 
+    def new_http(self):
+        # httplib2 connections are not thread safe, so each request gets its own authorized connection
+        if self.creds is None:
+            return None
+        return CountingHttp(AuthorizedHttp(self.creds, http=httplib2.Http(timeout=self.timeout)), self.metrics)
+
+    def load_sync_state(self, cal_id, startDatetime, endDatetime):
+        if not self.sync_store:
+            return None
+
+        state = self.sync_store.load(cal_id)
+
+        # A sync token only covers the window of the full sync it came from, so resync when the window moves past it
+        if state and not (dt.datetime.fromisoformat(state["timeMin"]) <= startDatetime and
+                          endDatetime <= dt.datetime.fromisoformat(state["timeMax"])):
+            self.logger.info(f"Window moved outside of the synced range for {cal_id}; resyncing")
+            state = None
+
+        return state
+
+    def list_kwargs(self, cal_id, state, startDatetime, endDatetime):
+        # Arguments for events().list: a delta request if we hold a sync token, a full listing otherwise
+        if state and state.get("syncToken"):
+            return dict(calendarId=cal_id, singleEvents=True, syncToken=state["syncToken"],
+                        fields=EVENT_FIELDS)
+
+        kwargs = dict(calendarId=cal_id, timeMin=startDatetime.isoformat(),
+                      timeMax=endDatetime.isoformat(), singleEvents=True, fields=EVENT_FIELDS)
+        if not self.sync_store:
+            # orderBy can't be combined with sync tokens; events are sorted after normalization anyway
+            kwargs["orderBy"] = 'startTime'
+        return kwargs
+
+    def is_sync_expired(self, exception, kwargs):
+        # 410 Gone: the sync token expired or was invalidated, so fall back to a full sync
+        return isinstance(exception, HttpError) and exception.resp.status == 410 and "syncToken" in kwargs
+
+    def iter_items(self, listing, **kwargs):
+        # Yield the items of every page of a listing as each page arrives, so no more than one page is held at once.
+        # The sync token, which only comes with the last page, is stored in listing['nextSyncToken'].
+        http = self.new_http()
+        request = self.service.events().list(**kwargs)
+        while request is not None:
+            response = request.execute(http=http)
+            yield from response.get('items', [])
+            listing['nextSyncToken'] = response.get('nextSyncToken')
+            request = self.service.events().list_next(request, response)
+
+    def in_synced_range(self, item, state):
+        # Whether a raw event overlaps the timeMin/timeMax range of the full sync its sync token came from
+        timeMin = dt.datetime.fromisoformat(state["timeMin"])
+        timeMax = dt.datetime.fromisoformat(state["timeMax"])
+        start = item.get('start', {})
+        end = item.get('end', {})
+        if 'dateTime' in start and 'dateTime' in end:
+            return (dt.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00')) <= timeMax and
+                    dt.datetime.fromisoformat(end['dateTime'].replace('Z', '+00:00')) >= timeMin)
+        if 'date' in start and 'date' in end:
+            # All-day events; the end date is exclusive
+            return (dt.date.fromisoformat(start['date']) <= timeMax.date() and
+                    dt.date.fromisoformat(end['date']) > timeMin.date())
+        return True
+
+    def apply_listing(self, cal_id, state, kwargs, items, listing):
+        # Fold a complete listing into the sync state (if enabled) and return the calendar's current raw events
+        if not self.sync_store:
+            return items
+
+        if "syncToken" in kwargs:
+            count = 0
+            for item in items:
+                count += 1
+                # Deltas aren't bound by the synced range: events created or moved outside of it would otherwise
+                # pile up in the sync state
+                if item.get('status') == 'cancelled' or not self.in_synced_range(item, state):
+                    state["events"].pop(item['id'], None)
+                else:
+                    state["events"][item['id']] = item
+            state["syncToken"] = listing.get('nextSyncToken')
+            self.logger.info(f"{count} changes synced for {cal_id}")
+        else:
+            state = {
+                "timeMin": kwargs["timeMin"],
+                "timeMax": kwargs["timeMax"],
+                "events": {item['id']: item for item in items if item.get('status') != 'cancelled'},
+            }
+            state["syncToken"] = listing.get('nextSyncToken')
+            self.logger.info(f"Full sync of {len(state['events'])} events for {cal_id}")
+
+        self.sync_store.save(cal_id, state)
+        return state["events"].values()
+
+    def to_events(self, items, startDatetime, endDatetime, localTZ, thresholdHours):
+        events = self.normalize_events(items, localTZ, thresholdHours)
+        if self.sync_store:
+            # Deltas are not bound by the window, so only keep what overlaps it
+            events = [event for event in events
+                      if event.startDatetime <= endDatetime and event.endDatetime >= startDatetime]
+        return events
+
+    def retrieve_calendar_events(self, cal, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Retrieve the events of a single calendar; safe to call from multiple threads at once
+        cal_id = cal["id"]
+        state = self.load_sync_state(cal_id, startDatetime, endDatetime)
+        kwargs = self.list_kwargs(cal_id, state, startDatetime, endDatetime)
+
+        listing = {}
+        try:
+            items = self.apply_listing(cal_id, state, kwargs, self.iter_items(listing, **kwargs), listing)
+            return self.to_events(items, startDatetime, endDatetime, localTZ, thresholdHours)
+        except HttpError as e:
+            if not self.is_sync_expired(e, kwargs):
+                raise
+            self.logger.info(f"Sync token expired for {cal_id}; resyncing")
+
+        kwargs = self.list_kwargs(cal_id, None, startDatetime, endDatetime)
+        items = self.apply_listing(cal_id, None, kwargs, self.iter_items(listing, **kwargs), listing)
+        return self.to_events(items, startDatetime, endDatetime, localTZ, thresholdHours)
+
+    def execute_batch(self, requests):
+        # Send the requests in as few HTTP exchanges as possible and return {request_id: (response, exception)}
+        results = {}
+
+        def callback(request_id, response, exception):
+            results[request_id] = (response, exception)
+
+        request_ids = list(requests)
+        for i in range(0, len(request_ids), MAX_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for request_id in request_ids[i:i + MAX_BATCH_SIZE]:
+                batch.add(requests[request_id], request_id=request_id)
+            batch.execute(http=self.new_http())
+
+        return results
+
+    def retrieve_batch(self, calendars, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Retrieve several calendars through batch requests. Returns one entry per calendar, in order: either its
+        # list of events, or the exception that calendar failed with, so one bad calendar doesn't sink the others.
+        jobs = {}
+        for i, cal in enumerate(calendars):
+            state = self.load_sync_state(cal["id"], startDatetime, endDatetime)
+            jobs[str(i)] = {
+                "cal": cal,
+                "state": state,
+                "kwargs": self.list_kwargs(cal["id"], state, startDatetime, endDatetime),
+                "items": [],
+                "pageToken": None,
+            }
+
+        results = [None] * len(calendars)
+        pending = list(jobs)
+        while pending:
+            # Every round batches the next page of each calendar that isn't complete yet
+            responses = self.execute_batch({
+                request_id: self.service.events().list(
+                    pageToken=jobs[request_id]["pageToken"], **jobs[request_id]["kwargs"])
+                for request_id in pending
+            })
+
+            pending = []
+            for request_id, (response, exception) in responses.items():
+                job = jobs[request_id]
+                cal_id = job["cal"]["id"]
+
+                if exception is not None:
+                    if self.is_sync_expired(exception, job["kwargs"]):
+                        self.logger.info(f"Sync token expired for {cal_id}; resyncing")
+                        job.update(state=None, items=[], pageToken=None,
+                                   kwargs=self.list_kwargs(cal_id, None, startDatetime, endDatetime))
+                        pending.append(request_id)
+                    else:
+                        self.logger.error(f"Failed to retrieve {cal_id}: {exception}")
+                        results[int(request_id)] = exception
+                    continue
+
+                if self.sync_store:
+                    job["items"].extend(response.get('items', []))
+                else:
+                    # Without sync state the raw items aren't needed past this page
+                    job["items"].extend(self.normalize_events(response.get('items', []), localTZ, thresholdHours))
+
+                job["pageToken"] = response.get('nextPageToken')
+                if job["pageToken"]:
+                    pending.append(request_id)
+                    continue
+
+                if self.sync_store:
+                    items = self.apply_listing(cal_id, job["state"], job["kwargs"], job["items"], response)
+                    results[int(request_id)] = self.to_events(
+                        items, startDatetime, endDatetime, localTZ, thresholdHours)
+                else:
+                    results[int(request_id)] = job["items"]
+
+        return results
+
     def retrieve_events(self, calendars, startDatetime, endDatetime, localTZ, thresholdHours):
         # Call the Google Calendar API and return a list of events that fall within the specified dates
-        eventList = []
-
         minTimeStr = startDatetime.isoformat()
         maxTimeStr = endDatetime.isoformat()
 
         self.logger.info('Retrieving events between ' +
                          minTimeStr + ' and ' + maxTimeStr + '...')
-        events_result = []
-        for cal in calendars:
-            events_result.append(
-                self.service.events().list(calendarId=cal, timeMin=minTimeStr,
-                                           timeMax=maxTimeStr, singleEvents=True,
-                                           orderBy='startTime').execute()
-            )
-
-        events = []
-        for eve in events_result:
-            events += eve.get('items', [])
-            # events = events_result.get('items', [])
-
-        if not events:
-            self.logger.info('No upcoming events found.')
-        for event in events:
-            # extracting and converting events data into a new list
-            newEvent = {}
-            newEvent['summary'] = event['summary']
-
-            if event['start'].get('dateTime') is None:
-                newEvent['allday'] = True
-                newEvent['startDatetime'] = self.to_datetime(
-                    event['start'].get('date'), localTZ)
-            else:
-                newEvent['allday'] = False
-                newEvent['startDatetime'] = self.to_datetime(
-                    event['start'].get('dateTime'), localTZ)
+        eventList = []
+        for events in self.retrieve_batch(calendars, startDatetime, endDatetime, localTZ, thresholdHours):
+            if isinstance(events, Exception):
+                raise events
+            eventList.extend(events)
 
-            if event['end'].get('dateTime') is None:
-                newEvent['endDatetime'] = self.adjust_end_time(self.to_datetime(event['end'].get('date'), localTZ),
-                                                               localTZ)
-            else:
-                newEvent['endDatetime'] = self.adjust_end_time(self.to_datetime(event['end'].get('dateTime'), localTZ),
-                                                               localTZ)
+        # We need to sort eventList because the event will be sorted in "calendar order" instead of hours order
+        return sorted(eventList, key=lambda k: k.startDatetime)
 
-            newEvent['updatedDatetime'] = self.to_datetime(
-                event['updated'], localTZ)
-            newEvent['isUpdated'] = self.is_recent_updated(
-                newEvent['updatedDatetime'], thresholdHours)
-            newEvent['isMultiday'] = self.is_multiday(
-                newEvent['startDatetime'], newEvent['endDatetime'])
-            eventList.append(newEvent)
+    def normalize_event(self, event, localTZ, thresholdHours):
+        # extracting and converting event data into the shape the renderer expects
+        if event['start'].get('dateTime') is None:
+            allday = True
+            startDatetime = self.to_datetime(event['start'].get('date'), localTZ)
+        else:
+            allday = False
+            startDatetime = self.to_datetime(event['start'].get('dateTime'), localTZ)
 
-        # We need to sort eventList because the event will be sorted in "calendar order" instead of hours order
-        eventList = sorted(eventList, key=lambda k: k['startDatetime'])
+        if event['end'].get('dateTime') is None:
+            endDatetime = self.adjust_end_time(self.to_datetime(event['end'].get('date'), localTZ), localTZ)
+        else:
+            endDatetime = self.adjust_end_time(self.to_datetime(event['end'].get('dateTime'), localTZ), localTZ)
+
+        updatedDatetime = self.to_datetime(event['updated'], localTZ)
+        return Event(
+            summary=event.get('summary', ''),
+            allday=allday,
+            startDatetime=startDatetime,
+            endDatetime=endDatetime,
+            isUpdated=self.is_recent_updated(updatedDatetime, thresholdHours),
+            isMultiday=self.is_multiday(startDatetime, endDatetime),
+            updatedDatetime=updatedDatetime,
+            uid=event.get('id'))
+
+    def normalize_events(self, events, localTZ, thresholdHours):
+        # Items are converted as they are consumed, so a streamed listing is never held in full. Only the conversion
+        # itself is timed, not the page requests the listing makes in between.
+        eventList = []
+        elapsed = 0
+        for event in events:
+            start = time.perf_counter()
+            eventList.append(self.normalize_event(event, localTZ, thresholdHours))
+            elapsed += time.perf_counter() - start
+        self.metrics.record("normalize", elapsed)
+
+        if not eventList:
+            self.logger.info('No upcoming events found.')
         return eventList
 
 
@@ -149,7 +389,7 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO)
 
-    calendars = ["primary"]
+    calendars = [{"id": "primary"}]
     displayTZ = timezone("America/Los_Angeles")
     thresholdHours = 24
     calStartDate = dt.date(2024, 9, 1)
@@ -158,7 +398,7 @@ if __name__ == "__main__":
         dt.datetime.combine(calStartDate, dt.datetime.min.time()))
     calEndDatetime = displayTZ.localize(
         dt.datetime.combine(calEndDate, dt.datetime.max.time()))
-    gcalService = GcalHelper()
+    gcalService = GcalHelper(incremental_sync=True)
     eventList = gcalService.retrieve_events(calendars, calStartDatetime,
                                             calEndDatetime, displayTZ, thresholdHours)
 
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persisted incremental sync state for Google calendars. For each calendar we keep the nextSyncToken returned by the
+API, the window the last full sync covered, and the raw events received so far, so later runs only need to ask the
+API for what changed since.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import hashlib
+import json
+import logging
+import pathlib
+
+from atomic import write_atomic
+
+
+class SyncStore:
+
+    def __init__(self, state_dir=None):
+        self.logger = logging.getLogger(__name__)
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.state_dir = state_dir or f"{self.currPath}/sync"
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def path_for(self, cal_id):
+        return f"{self.state_dir}/{hashlib.sha1(cal_id.encode('utf-8')).hexdigest()}.json"
+
+    def load(self, cal_id):
+        try:
+            with open(self.path_for(cal_id), "r") as fo:
+                state = json.load(fo)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # Guard against hash collisions and hand-edited files
+        if state.get("calendarId") != cal_id:
+            return None
+        return state
+
+    def save(self, cal_id, state):
+        state["calendarId"] = cal_id
+        write_atomic(self.path_for(cal_id), json.dumps(state))
+
+    def clear(self, cal_id):
+        try:
+            os.remove(self.path_for(cal_id))
+        except FileNotFoundError:
+            pass
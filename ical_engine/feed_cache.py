@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for iCal feeds. The raw body of each feed is stored alongside its ETag/Last-Modified validators so
+that later runs can send a conditional request; a 304 response means the cached body can be reused without
+downloading the feed again.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import hashlib
+import json
+import logging
+import pathlib
+
+import requests
+
+from atomic import write_atomic
+from metrics import Metrics
+
+
+class FeedCache:
+
+    def __init__(self, cache_dir=None, timeout=30, metrics=None):
+        self.logger = logging.getLogger(__name__)
+        self.metrics = metrics or Metrics()
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.cache_dir = cache_dir or f"{self.currPath}/cache"
+        self.timeout = timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def feed_key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def path_for(self, url, suffix):
+        return f"{self.cache_dir}/{self.feed_key(url)}.{suffix}"
+
+    def normalize_url(self, url):
+        # Same protocol fix icalevents applies for Apple calendars
+        if url.startswith("webcal://"):
+            url = url.replace("webcal://", "http://", 1)
+        return url
+
+    def load_meta(self, url):
+        try:
+            with open(self.path_for(url, "json"), "r") as fo:
+                return json.load(fo)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def fetch(self, url):
+        # Returns a tuple of (path to the cached body, whether the body changed since the last fetch)
+        meta = self.load_meta(url)
+        body_path = self.path_for(url, "ics")
+
+        headers = {}
+        if os.path.exists(body_path):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("lastModified"):
+                headers["If-Modified-Since"] = meta["lastModified"]
+
+        response = requests.get(self.normalize_url(url), headers=headers, timeout=self.timeout)
+        self.metrics.add_bytes(len(response.content))
+
+        if response.status_code == 304:
+            self.logger.info(f"Feed not modified: {url}")
+            if not meta.get("sha256"):
+                # Written before bodies were hashed
+                with open(body_path, "rb") as fo:
+                    meta["sha256"] = hashlib.sha256(fo.read()).hexdigest()
+                write_atomic(self.path_for(url, "json"), json.dumps(meta).encode("utf-8"))
+            return body_path, False
+
+        response.raise_for_status()
+        if not response.content:
+            raise ConnectionError(f"Could not get data from {url}!")
+
+        # The meta describes the body (validators, hash), so it is removed before the body is replaced and only
+        # written again afterwards: if the run dies in between, the next one finds no meta and downloads the feed
+        try:
+            os.remove(self.path_for(url, "json"))
+        except FileNotFoundError:
+            pass
+        write_atomic(body_path, response.content)
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "lastModified": response.headers.get("Last-Modified"),
+            "size": len(response.content),
+            "sha256": hashlib.sha256(response.content).hexdigest(),
+        }
+        write_atomic(self.path_for(url, "json"), json.dumps(meta).encode("utf-8"))
+        self.logger.info(f"Feed downloaded ({len(response.content)} bytes): {url}")
+
+        return body_path, True
+
+    def content_hash(self, url):
+        # Hash of the cached body, recorded when it was downloaded; None if it is unknown
+        return self.load_meta(url).get("sha256")
+
+
+if __name__ == "__main__":
+    # Exercise the cache against a local HTTP stand-in that honours If-None-Match
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    logging.basicConfig(level=logging.INFO)
+
+    FEED = b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nEND:VCALENDAR\r\n"
+    ETAG = '"v1"'
+
+    class FeedHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get("If-None-Match") == ETAG:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", str(len(FEED)))
+            self.end_headers()
+            self.wfile.write(FEED)
+
+    server = HTTPServer(("127.0.0.1", 0), FeedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/feed.ics"
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = FeedCache(cache_dir=cache_dir)
+        print(cache.fetch(url))  # changed: True
+        print(cache.fetch(url))  # changed: False
+
+    server.shutdown()
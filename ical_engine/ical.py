@@ -5,21 +5,51 @@ This is where we retrieve events from the iCloud Calendar. Before doing so, make
 credentials.json in the same folder as this file.
 """
 
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
 import datetime as dt
 import logging
 import os.path
 import pathlib
+import multiprocessing
 import pytz
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import replace
+
+from event import Event
+
+from ical_engine.feed_cache import FeedCache
+from ical_engine.occurrence_cache import OccurrenceCache
+from ical_engine.prune import prune_feed
+from metrics import Metrics
 
-import icalevents.icalevents as ical
+# icalevents only returns the occurrences of a recurring event that start inside the range it expands, so the range
+# starts this much before the window: occurrences that began earlier but still overlap the window are found too
+EXPANSION_MARGIN = dt.timedelta(days=7)
 
 
 class IcalHelper:
 
-    def __init__(self, calendars):
+    def __init__(self, calendars, cache_dir=None, timeout=30, prune=False, metrics=None, process_workers=0,
+                 process_threshold=256 * 1024):
         self.logger = logging.getLogger(__name__)
         self.currPath = str(pathlib.Path(__file__).parent.absolute())
         self.calendars = calendars
+        self.metrics = metrics or Metrics()
+        self.feed_cache = FeedCache(cache_dir=cache_dir, timeout=timeout, metrics=self.metrics)
+        self.occurrence_cache = OccurrenceCache(cache_dir=cache_dir)
+        self.prune = prune
+        # Feeds of at least process_threshold bytes are parsed in a pool of process_workers processes (0: never)
+        self.process_workers = process_workers
+        self.process_threshold = process_threshold
+        self.pool = None
+        self.pool_lock = threading.Lock()
 
     def list_calendars(self):
         # helps to retrieve ID for calendars within the account
@@ -34,82 +64,160 @@ class IcalHelper:
     def is_recent_updated(self, event, thresholdHours):
         # consider events updated within the past X hours as recently updated
         utcnow = dt.datetime.now(dt.timezone.utc)
-        diff = (utcnow - event['updatedDatetime']).total_seconds() / 3600
-        event['isUpdated'] = diff < thresholdHours
-
-        return event
+        diff = (utcnow - event.updatedDatetime).total_seconds() / 3600
+        return replace(event, isUpdated=diff < thresholdHours)
 
     def normalize_allday_time(self, event, localTZ):
-        if event['allday']:
-            utc_start = event['startDatetime'].astimezone(pytz.utc)
-            utc_end = event['endDatetime'].astimezone(pytz.utc)
+        if event.allday:
+            utc_start = event.startDatetime.astimezone(pytz.utc)
+            utc_end = event.endDatetime.astimezone(pytz.utc)
 
             # check if end time is at 00:00 of next day, if so set to max time for day before
             if utc_end.hour == 0 and utc_end.minute == 0 and utc_end.second == 0:
                 newEndtime = dt.datetime.combine(utc_end.date() - dt.timedelta(days=1), dt.datetime.max.time())
                 utc_end = newEndtime
 
-            event['startDatetime'] = utc_start.replace(tzinfo=localTZ)
-            event['endDatetime'] = utc_end.replace(tzinfo=localTZ)
+            event = replace(event, startDatetime=utc_start.replace(tzinfo=localTZ),
+                            endDatetime=utc_end.replace(tzinfo=localTZ))
 
         return event
 
     def is_multiday(self, event):
         # check if event stretches across multiple days
-        event['isMultiday'] = event['startDatetime'].date() != event['endDatetime'].date()
+        return replace(event, isMultiday=event.startDatetime.date() != event.endDatetime.date())
+
+    def to_event(self, e):
+        # Only the fields the renderer needs are kept from icalevents' Event
+        return Event(summary=e.summary or '', allday=e.all_day, startDatetime=e.start, endDatetime=e.end,
+                     isUpdated=False, isMultiday=False, updatedDatetime=e.last_modified, uid=e.uid)
+
+    def expand(self, body_path, startDatetime, endDatetime, localTZ):
+        # icalevents (and icalendar/dateutil through it) is only loaded when a feed actually needs expanding
+        import icalevents.icalevents as ical
+
+        if not self.prune:
+            return [self.to_event(e) for e in
+                    ical.events(file=body_path,
+                                start=startDatetime, end=endDatetime,
+                                fix_apple=True, sort=True, tzinfo=localTZ)]
+
+        # Stream the feed through the pruner first, so only events that can reach the window get parsed
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(body_path), suffix=".ics") as pruned:
+            prune_feed(body_path, pruned.name, startDatetime.date(), endDatetime.date())
+            return [self.to_event(e) for e in
+                    ical.events(file=pruned.name,
+                                start=startDatetime, end=endDatetime,
+                                fix_apple=True, sort=True, tzinfo=localTZ)]
+
+    def parse_feed(self, url, body_path, content_hash, startDatetime, endDatetime, localTZ):
+        # Only expand the parts of the range that weren't expanded before
+        tz = str(localTZ)
+        expandStart = startDatetime - EXPANSION_MARGIN
+
+        events, missing = self.occurrence_cache.lookup(url, content_hash, tz, expandStart, endDatetime)
+        if not missing:
+            self.logger.info(f"Using cached occurrences for {url}")
+
+        for start, end in missing:
+            self.logger.info(f"Expanding {url} between {start.isoformat()} and {end.isoformat()}")
+            with self.metrics.stage("parse"):
+                events = self.occurrence_cache.merge(events, self.expand(body_path, start, end, localTZ))
+
+        if missing and content_hash is not None:
+            # Stored before normalization, which depends on the current time; without a hash of the body the
+            # occurrences couldn't be matched to it later
+            self.occurrence_cache.store(url, content_hash, tz, expandStart, endDatetime, events)
+
+        # The same rule for cached and freshly expanded occurrences: everything that overlaps the window
+        return [event for event in events if self.overlaps(event, startDatetime, endDatetime, localTZ)]
+
+    def overlaps(self, event, startDatetime, endDatetime, localTZ):
+        # All-day events are compared at local midnight, as icalevents does and as they are shown
+        event = self.normalize_allday_time(event, localTZ)
+        return event.endDatetime >= startDatetime and event.startDatetime <= endDatetime
+
+    def normalize(self, events, localTZ, thresholdHours):
+        normalized = []
+        with self.metrics.stage("normalize"):
+            for event in events:
+                # Floating (all-day) events are always in UTC, which should be converted to the local time
+                # i.e. UTC 00:00 --> PST 00:00
+                event = self.normalize_allday_time(event, localTZ)
+                event = self.is_recent_updated(event, thresholdHours)
+                event = self.is_multiday(event)
+                normalized.append(event)
+
+        return normalized
+
+    def parse_and_normalize(self, url, body_path, content_hash, startDatetime, endDatetime, localTZ, thresholdHours):
+        return self.normalize(self.parse_feed(url, body_path, content_hash, startDatetime, endDatetime, localTZ),
+                              localTZ, thresholdHours)
+
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                # Spawned rather than forked: the fetch runs on several threads, which fork doesn't mix well with
+                self.pool = ProcessPoolExecutor(max_workers=self.process_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def submit_calendar(self, cal, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Download the feed (only if it changed), then parse and normalize it. Large feeds go to a worker process
+        # when the pool is enabled, and a Future is returned; everything else is handled here and the events returned.
+        url = cal["id"]
+        body_path, _ = self.feed_cache.fetch(url)
+        args = (url, body_path, self.feed_cache.content_hash(url), startDatetime, endDatetime, localTZ, thresholdHours)
+
+        if self.process_workers and os.path.getsize(body_path) >= self.process_threshold:
+            self.logger.info(f"Parsing {url} in a worker process")
+            return self.get_pool().submit(parse_in_worker, self.occurrence_cache.cache_dir, self.prune, *args)
+        return self.parse_and_normalize(*args)
+
+    def collect(self, cal, events):
+        if isinstance(events, Future):
+            # Parsing and normalization happened in the worker; only the wait is measured here
+            with self.metrics.stage("parse_worker"):
+                events = events.result()
 
-        return event
+        if not events:
+            self.logger.info(f'No upcoming events found in {cal["id"]}.')
+        return events
 
-    def map_keys(self, key_map, d):
-        for old_key, new_key in key_map:
-            d[new_key] = d.pop(old_key)
-        return d
+    def retrieve_calendar_events(self, cal, startDatetime, endDatetime, localTZ, thresholdHours):
+        # Retrieve and normalize the events of a single calendar; safe to call from multiple threads at once
+        return self.collect(cal, self.submit_calendar(cal, startDatetime, endDatetime, localTZ, thresholdHours))
 
     def retrieve_events(self, startDatetime, endDatetime, localTZ, thresholdHours):
-        # Call the Google Calendar API and return a list of events that fall within the specified dates
-        eventList = []
-
+        # Retrieve the events of every calendar that fall within the specified dates
         minTimeStr = startDatetime.isoformat()
         maxTimeStr = endDatetime.isoformat()
 
         self.logger.info('Retrieving events between ' +
                          minTimeStr + ' and ' + maxTimeStr + '...')
-        events_result = []
-        for cal in self.calendars:
-            events_result.extend(
-                ical.events(url=cal["id"],
-                            start=startDatetime, end=endDatetime,
-                            fix_apple=True, sort=True, tzinfo=localTZ)
-            )
-
-        key_map = [
-            ("all_day", "allday"),
-            ("end", "endDatetime"),
-            ("start", "startDatetime"),
-            ("last_modified", "updatedDatetime")
-        ]
-        events = [self.map_keys(key_map, vars(e)) for e in events_result]
+        # Submit every calendar before collecting any, so large feeds are parsed in parallel when the pool is enabled
+        pending = [(cal, self.submit_calendar(cal, startDatetime, endDatetime, localTZ, thresholdHours))
+                   for cal in self.calendars]
+        events = []
+        for cal, result in pending:
+            events.extend(self.collect(cal, result))
 
-        if not events:
-            self.logger.info('No upcoming events found.')
+        # Sort eventList because the event will be sorted in "calendar order" instead of hours order
+        return sorted(events, key=lambda k: k.startDatetime)
 
-        for event in events:
-            # Floating (all-day) events are always in UTC, which should be converted to the local time
-            # i.e. UTC 00:00 --> PST 00:00
-            event = self.normalize_allday_time(event, localTZ)
-            event = self.is_recent_updated(event, thresholdHours)
-            event = self.is_multiday(event)
 
-         # Sort eventList because the event will be sorted in "calendar order" instead of hours order
-        return sorted(events, key=lambda k: k['startDatetime'])
+def parse_in_worker(cache_dir, prune, *args):
+    # Entry point of the worker processes: a helper sharing the parent's caches parses and normalizes one feed and
+    # sends back the (compactly pickled) events
+    return IcalHelper([], cache_dir=cache_dir, prune=prune).parse_and_normalize(*args)
 
 
 if __name__ == "__main__":
-    import os
-    import sys
-    here = os.path.dirname(__file__)
-    sys.path.append(os.path.join(here, '..'))
-
     from pprint import pprint
     from pytz import timezone
     from config import Config
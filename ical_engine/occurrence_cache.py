@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of expanded event occurrences, keyed by feed content hash, window and timezone. Expanding every RRULE of a
+feed is the most expensive part of reading it, so an unchanged feed over the same window is never expanded again,
+and when the window slides only the newly exposed part of it needs expanding.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import hashlib
+import logging
+import pathlib
+import pickle
+
+from atomic import write_atomic
+
+# Bumped whenever the stored event type or range changes, so older entries are expanded again instead of misread
+FORMAT = 3
+
+
+class OccurrenceCache:
+
+    def __init__(self, cache_dir=None):
+        self.logger = logging.getLogger(__name__)
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        self.cache_dir = cache_dir or f"{self.currPath}/cache"
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, url):
+        return f"{self.cache_dir}/{hashlib.sha1(url.encode('utf-8')).hexdigest()}.occurrences.pickle"
+
+    def load(self, url):
+        try:
+            with open(self.path_for(url), "rb") as fo:
+                return pickle.load(fo)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    def store(self, url, content_hash, tz, start, end, events):
+        write_atomic(self.path_for(url), pickle.dumps(
+            {"format": FORMAT, "hash": content_hash, "tz": tz, "start": start, "end": end, "events": events}))
+
+    def lookup(self, url, content_hash, tz, start, end):
+        # Returns (cached events that expanding the range would return, list of (start, end) ranges that still need
+        # expanding). Expanding returns single events that overlap the range, but only those occurrences of
+        # recurring events that start inside it.
+        entry = self.load(url)
+        if content_hash is None or not entry or entry.get("format") != FORMAT or entry["hash"] != content_hash or entry["tz"] != tz:
+            return [], [(start, end)]
+
+        if entry["end"] < start or entry["start"] > end:
+            # No overlap with what was expanded before
+            return [], [(start, end)]
+
+        if any(entry["start"] <= event.startDatetime < start <= event.endDatetime for event in entry["events"]):
+            # Something began before the new range and lasts into it: a single event would be expanded again, an
+            # occurrence of a recurring one wouldn't, and events don't say which they are
+            return [], [(start, end)]
+
+        events = [event for event in entry["events"]
+                  if event.endDatetime >= start and event.startDatetime <= end]
+
+        missing = []
+        if start < entry["start"]:
+            missing.append((start, entry["start"]))
+        if end > entry["end"]:
+            missing.append((entry["end"], end))
+        return events, missing
+
+    def merge(self, events, new_events):
+        # Occurrences straddling a range boundary are returned by both expansions, so de-duplicate them
+        seen = {(event.uid, event.startDatetime) for event in events}
+        merged = list(events)
+        for event in new_events:
+            key = (event.uid, event.startDatetime)
+            if key not in seen:
+                seen.add(key)
+                merged.append(event)
+        return sorted(merged, key=lambda k: k.startDatetime)
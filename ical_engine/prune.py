@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming, window-pruning pass over an ICS feed. The feed is read line by line and only one VEVENT is held at a time;
+non-recurring events that fall entirely outside the window are dropped after a cheap scan of their date properties,
+without being parsed. Everything else (calendar properties, VTIMEZONEs, recurring series and their overrides) is
+written through unchanged, so icalevents only has to parse what the view can actually show.
+"""
+
+import datetime as dt
+import logging
+
+# Dates are compared without timezone conversion, so allow a day either side of the window
+MARGIN = dt.timedelta(days=1)
+
+RECURRENCE_PROPERTIES = ("RRULE", "RDATE")
+
+
+def property_name(line):
+    # "DTSTART;TZID=America/Los_Angeles:20240901T100000" -> "DTSTART"
+    end = len(line)
+    for sep in (";", ":"):
+        index = line.find(sep)
+        if index != -1:
+            end = min(end, index)
+    return line[:end].upper()
+
+
+def property_date(line):
+    # Only the date part of the value matters for pruning: "...:20240901T100000Z" -> date(2024, 9, 1)
+    value = line[line.rfind(":") + 1:].strip()
+    try:
+        return dt.datetime.strptime(value[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+def logical_lines(fo):
+    # Unfold continuation lines (RFC 5545 3.1), yielding (logical line, list of physical lines)
+    current = None
+    raw = []
+    for line in fo:
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:].rstrip("\r\n")
+            raw.append(line)
+            continue
+        if current is not None:
+            yield current, raw
+        current = line.rstrip("\r\n")
+        raw = [line]
+    if current is not None:
+        yield current, raw
+
+
+def keep_event(properties, window_start, window_end):
+    # Decide from the collected {name: logical line} of a VEVENT whether it can affect the window
+    if any(name in properties for name in RECURRENCE_PROPERTIES):
+        return True
+
+    start = property_date(properties["DTSTART"]) if "DTSTART" in properties else None
+    if start is None:
+        return True
+
+    if "DTEND" in properties:
+        end = property_date(properties["DTEND"]) or start
+    elif "DURATION" in properties:
+        # Durations can be long; only rule out events that start after the window
+        end = window_end
+    else:
+        end = start
+
+    in_window = start <= window_end + MARGIN and end >= window_start - MARGIN
+
+    # Overrides of a recurring instance also matter if the instance they replace was in the window
+    if not in_window and "RECURRENCE-ID" in properties:
+        original = property_date(properties["RECURRENCE-ID"])
+        in_window = original is None or window_start - MARGIN <= original <= window_end + MARGIN
+
+    return in_window
+
+
+def prune_feed(in_path, out_path, window_start, window_end):
+    # Copy in_path to out_path without the events that can't appear between window_start and window_end (dates).
+    # Returns (events kept, events dropped).
+    logger = logging.getLogger(__name__)
+    kept = 0
+    dropped = 0
+
+    with open(in_path, "r", encoding="utf-8", errors="replace", newline="") as fi, \
+            open(out_path, "w", encoding="utf-8", newline="") as fo:
+        event_raw = None
+        properties = None
+        for line, raw in logical_lines(fi):
+            upper = line.upper()
+            if upper == "BEGIN:VEVENT" and event_raw is None:
+                event_raw = list(raw)
+                properties = {}
+                continue
+
+            if event_raw is None:
+                fo.writelines(raw)
+                continue
+
+            event_raw.extend(raw)
+            if upper == "END:VEVENT":
+                if keep_event(properties, window_start, window_end):
+                    fo.writelines(event_raw)
+                    kept += 1
+                else:
+                    dropped += 1
+                event_raw = None
+                continue
+
+            name = property_name(line)
+            # Only the first occurrence of each property is needed (nested VALARMs come after the dates)
+            if name not in properties:
+                properties[name] = line
+
+    logger.info(f"Pruned feed: {kept} events kept, {dropped} dropped")
+    return kept, dropped
@@ -1,128 +1,473 @@
 #!/usr/bin/env python3
 
+import argparse
 import datetime as dt
 import logging
 import pathlib
-import pickle
+import random
+import signal
+import threading
+import time
 
 from pytz import timezone
 
 from config import Config
-from epd_hidapi.host.image import Image
-from epd_hidapi.host.panel import Panel
-from ical_engine.ical import IcalHelper
-from render_engine.render import RenderHelper
+from fetch_engine.fetch import FetchHelper
+from fingerprint import FingerprintStore, view_digest
+from metrics import Metrics
 
+# Rendering, image processing and the panel driver are imported where they're used, so a run that finds nothing
+# to refresh never pays for loading them (see benchmarks/startup_budget.py)
 
-def should_refresh(event_list, today):
-    _path = str(pathlib.Path(__file__).parent.absolute())
-    refresh = False
-    last = {}
 
-    try:
-        with open(f"{_path}/last.pickle", "rb") as fo:
-            last = pickle.load(fo)
-
-    except FileNotFoundError:
-        # First run: always refresh
-        refresh = True
+def should_refresh(event_list, today, store=None):
+    # Compare a digest of the render-relevant event fields (and the day) with the one from the last refresh
+    store = store or FingerprintStore()
+    last = store.load()
+    digest = view_digest(event_list, today)
 
-    if event_list != last.get("event_list") or today != last.get("today"):
-        refresh = True
+    # First run (no record) always refreshes
+    refresh = digest != last.get("digest")
 
-    # Save for next time
+    # Save for next time, keeping what the refresh adds to the record (the frame on the panel, a pre-render)
     if refresh:
-        last["today"] = today
-        last["event_list"] = event_list
-        with open(f"{_path}/last.pickle", "wb") as fo:
-            pickle.dump(last, fo)
+        last.update({
+            "today": today.isoformat(),
+            "digest": digest,
+            "events": len(event_list),
+            "saved": dt.datetime.now().isoformat(),
+        })
+        store.save(last)
 
     return refresh
 
 
-def main():
-    # Basic configuration settings (user replaceable)
-    config = Config()
+class CalendarUpdater:
+    # Holds the configuration and calendar services across updates so that a long-running process only pays for
+    # config parsing, OAuth and API discovery once (or again on reload)
 
-    # Create and configure logger
-    logging.basicConfig()
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    logger.info("Starting calendar update")
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.renderWorker = None
+        self.fetchService = None
+        # Events and window of the last fetch, for pre-rendering tomorrow's frame
+        self.lastFetch = None
+        self.load()
 
-    try:
-        # Establish current date and time information
+    def load(self):
+        # Basic configuration settings (user replaceable). Everything is built before anything is replaced, so a
+        # broken config.json on reload leaves the previous configuration and services running.
+        config = Config()
+        config.displayTZ = timezone(config.displayTZ)
+        metrics = Metrics(config.get("metricsDir"))
+        fetchService = FetchHelper(config.get("calendars", []),
+                                   max_workers=config.get("fetchWorkers", 4),
+                                   timeout=config.get("fetchTimeoutSeconds", 30),
+                                   gcal_incremental_sync=config.get("gcalIncrementalSync", False),
+                                   gcal_batch=config.get("gcalBatchRequests", False),
+                                   ical_prune=config.get("icalPruneFeeds", False),
+                                   metrics=metrics,
+                                   deadline=config.get("fetchDeadlineSeconds"),
+                                   breaker_threshold=config.get("fetchBreakerThreshold", 3),
+                                   breaker_backoff=config.get("fetchBackoffSeconds", 300),
+                                   breaker_max_backoff=config.get("fetchMaxBackoffSeconds", 6 * 3600),
+                                   ical_process_workers=config.get("icalProcessWorkers", 0),
+                                   ical_process_threshold=config.get("icalProcessThresholdBytes", 256 * 1024))
+
+        renderWorker = None
+        if config.get("renderWorker", False) and config.get("renderBackend", "html") == "html":
+            try:
+                from render_engine.worker import RenderWorker
+                # Xvfb is only started by the first render job
+                renderWorker = RenderWorker(width=config.screenWidth, height=config.screenHeight)
+            except Exception:
+                fetchService.close()
+                raise
+
+        self.close()
+        self.config = config
+        self.metrics = metrics
+        self.fetchService = fetchService
+        self.renderWorker = renderWorker
+
+    def close(self):
+        if self.fetchService:
+            self.fetchService.close()
+            self.fetchService = None
+        if self.renderWorker:
+            self.renderWorker.stop()
+            self.renderWorker = None
+
+    def update(self):
+        # Every update is one run record: written whether or not the update succeeds
+        self.metrics.begin()
+        try:
+            self.refresh()
+        except Exception as e:
+            self.write_metrics(f"{type(e).__name__}: {e}")
+            raise
+        try:
+            self.prerender()
+        except Exception as e:
+            # Speculative work: the panel is already up to date, and midnight will render normally
+            self.logger.warning(f"Could not pre-render tomorrow's frame: {e}")
+        self.write_metrics()
+
+    def write_metrics(self, error=None):
+        try:
+            self.metrics.write(error)
+        except OSError as e:
+            # Monitoring must never stop the panel from updating
+            self.logger.warning(f"Could not write metrics: {e}")
+
+    def calendar_window(self, currDate):
         # Note: For Python datetime.weekday() - Monday = 0, Sunday = 6
         # For this implementation, each week starts on a Sunday and the calendar begins on the nearest elapsed Sunday
-        # The calendar will also display 5 weeks of events to cover the upcoming month, ending on a Saturday
-        config.displayTZ = timezone(config.displayTZ)
-        currDatetime = dt.datetime.now(config.displayTZ)
-        logger.info("Time synchronised to {}".format(currDatetime))
-        currDate = currDatetime.date()
+        # The calendar will also display numWeeks (5 by default) weeks of events to cover the upcoming month,
+        # ending on a Saturday; the view and the fetch window are both derived from this setting
+        config = self.config
         calStartDate = currDate - \
             dt.timedelta(
                 days=((currDate.weekday() + (7 - config.weekStartDay)) % 7))
-        calEndDate = calStartDate + dt.timedelta(days=(5 * 7 - 1))
+        calEndDate = calStartDate + dt.timedelta(days=(config.get("numWeeks", 5) * 7 - 1))
         calStartDatetime = config.displayTZ.localize(
             dt.datetime.combine(calStartDate, dt.datetime.min.time()))
         calEndDatetime = config.displayTZ.localize(
             dt.datetime.combine(calEndDate, dt.datetime.max.time()))
+        return calStartDate, calStartDatetime, calEndDatetime
+
+    def refresh(self):
+        config = self.config
+        logger = self.logger
+
+        # Establish current date and time information
+        currDatetime = dt.datetime.now(config.displayTZ)
+        logger.info("Time synchronised to {}".format(currDatetime))
+        currDate = currDatetime.date()
+        calStartDate, calStartDatetime, calEndDatetime = self.calendar_window(currDate)
 
         # Retrieve all events within start and end date (inclusive)
         start = dt.datetime.now()
-        eventList = []
-
-        gcal_calendars = [
-            cal for cal in config.calendars if cal.get("type") == "gcal"]
-        logger.info("gcal_calendars: " + str(gcal_calendars))
-        if gcal_calendars:
-            # Use lazy imports so that gcal credentials aren't required if not using a google calendar
-            from gcal_engine.gcal import GcalHelper
-            gcalService = GcalHelper()
-            eventList.extend(gcalService.retrieve_events(
-                gcal_calendars, calStartDatetime, calEndDatetime, config.displayTZ, config.thresholdHours))
-
-        ical_calendars = [
-            cal for cal in config.calendars if cal.get("type") == "ical"]
-        logger.info("ical_calendars: " + str(ical_calendars))
-        if ical_calendars:
-            icalService = IcalHelper(ical_calendars)
-            eventList.extend(icalService.retrieve_events(
-                calStartDatetime, calEndDatetime, config.displayTZ, config.thresholdHours))
+        eventList = self.fetchService.retrieve_events(
+            calStartDatetime, calEndDatetime, config.displayTZ, config.thresholdHours)
+        self.lastFetch = (eventList, calStartDatetime, calEndDatetime)
 
         logger.info(f"{len(eventList)} calendar events retrieved in " +
                     str(dt.datetime.now() - start))
+        self.claim_prerender(eventList, currDate)
 
         # Only proceed if the calendar events have changed, or it's a new day.
-        if not should_refresh(eventList, currDate):
+        with self.metrics.stage("should_refresh"):
+            refresh = should_refresh(eventList, currDate)
+        if not refresh:
             logger.info("No updates; not refreshing panel")
             return
 
         logger.info("Refreshing panel")
+        from render_engine.frame_cache import FrameCache
+        from render_engine.render import RenderHelper
         renderService = RenderHelper(
-            events=eventList, start_date=calStartDate, today=currDate)
-        renderService.process_inputs()
+            events=eventList, start_date=calStartDate, today=currDate, worker=self.renderWorker,
+            config=config, metrics=self.metrics)
+        with self.metrics.stage("build_view"):
+            view = renderService.build_view(config)
+
+        # Identical views (e.g. only an off-screen event changed) map to the same frame
+        frameCache = FrameCache()
+        frameKey = frameCache.key(view, self.render_settings())
+        store = FingerprintStore()
+        record = store.load()
+        if record.get("frame") == frameKey:
+            logger.info("View unchanged; not refreshing panel")
+            return
+
+        planes = frameCache.load(frameKey)
+        if planes is None:
+            planes = self.render_frame(renderService, view)
+            frameCache.store(frameKey, *planes)
+
+        self.upload_frame(*planes)
+        record["frame"] = frameKey
+        store.save(record)
+
+    def prerender(self):
+        # Late in the evening, build tomorrow's frame from the events already fetched and leave it in the frame
+        # cache: the first update after midnight then uploads it straight away instead of rendering at the moment
+        # every display refreshes
+        config = self.config
+        afterHour = config.get("preRenderAfterHour")
+        if afterHour is None or self.lastFetch is None:
+            return
+        now = dt.datetime.now(config.displayTZ)
+        if now.hour < afterHour:
+            return
+
+        eventList, fetchStart, fetchEnd = self.lastFetch
+        tomorrow = now.date() + dt.timedelta(days=1)
+        calStartDate, calStartDatetime, calEndDatetime = self.calendar_window(tomorrow)
+        if calStartDatetime < fetchStart or calEndDatetime > fetchEnd:
+            # The calendar moves on a week at this rollover, so today's events don't cover tomorrow's view
+            self.logger.info("Tomorrow's calendar starts a new week; not pre-rendering")
+            return
+
+        # The events as the first update after midnight will see them: same window, recent updates re-evaluated
+        midnight = config.displayTZ.localize(dt.datetime.combine(tomorrow, dt.datetime.min.time()))
+        events = [event.with_recent_update(config.thresholdHours, midnight) for event in eventList]
+        digest = view_digest(events, tomorrow)
+        store = FingerprintStore()
+        record = store.load()
+        if record.get("prerender", {}).get("digest") == digest:
+            return
+
+        self.logger.info(f"Pre-rendering the frame for {tomorrow}")
+        from render_engine.frame_cache import FrameCache
+        from render_engine.render import RenderHelper
+        with self.metrics.stage("prerender", day="tomorrow"):
+            renderService = RenderHelper(
+                events=events, start_date=calStartDate, today=tomorrow, worker=self.renderWorker,
+                config=config, metrics=self.metrics)
+            view = renderService.build_view(config)
+            frameCache = FrameCache()
+            frameKey = frameCache.key(view, self.render_settings())
+            if frameCache.load(frameKey) is None:
+                frameCache.store(frameKey, *self.render_frame(renderService, view))
+
+        stale = record.get("prerender")
+        if stale and stale["frame"] != frameKey:
+            # Superseded by events that changed during the evening
+            frameCache.discard(stale["frame"])
+        record["prerender"] = {"date": tomorrow.isoformat(), "digest": digest, "frame": frameKey}
+        store.save(record)
+
+    def claim_prerender(self, eventList, currDate):
+        # Once its day has come, a pre-rendered frame is either used or thrown away. When the events still match,
+        # the view is the same too, so the refresh below finds the frame in the frame cache and uploads it directly.
+        store = FingerprintStore()
+        record = store.load()
+        prerendered = record.get("prerender")
+        if not prerendered or prerendered["date"] > currDate.isoformat():
+            return
+
+        if prerendered["date"] == currDate.isoformat() and \
+                prerendered["digest"] == view_digest(eventList, currDate):
+            self.logger.info("Events unchanged since the pre-render; using the pre-rendered frame")
+        else:
+            self.logger.info("Events changed since the pre-render; discarding the pre-rendered frame")
+            from render_engine.frame_cache import FrameCache
+            FrameCache().discard(prerendered["frame"])
+        del record["prerender"]
+        store.save(record)
+
+    def render_settings(self):
+        # Everything besides the view model that changes the final bitplanes
+        config = self.config
+        return {
+            "backend": config.get("renderBackend", "html"),
+            "screenWidth": config.screenWidth,
+            "screenHeight": config.screenHeight,
+            "ditherImage": config.ditherImage,
+            "imagePipeline": config.get("imagePipeline", "epd"),
+        }
+
+    def render_frame(self, renderService, view):
+        config = self.config
+        renderService.process_inputs(view)
 
         _path = str(pathlib.Path(__file__).parent.absolute())
         infile = f"{_path}/render_engine/calendar.png"
-        image = Image(infile)
-        image.resize(width=config.screenWidth, height=config.screenHeight)
-        image.rotate(rotation=90)
-        image.quantize(dither=config.ditherImage)
-        image.extract(threshold=200)
+        metrics = self.metrics
+        with metrics.stage("image_load"):
+            if config.get("imagePipeline", "epd") == "numpy":
+                from display_engine.image import ImagePipeline
+                image = ImagePipeline(infile)
+            else:
+                from epd_hidapi.host.image import Image
+                image = Image(infile)
+        with metrics.stage("image_resize"):
+            image.resize(width=config.screenWidth, height=config.screenHeight)
+        with metrics.stage("image_rotate"):
+            image.rotate(rotation=90)
+        with metrics.stage("image_quantize"):
+            image.quantize(dither=config.ditherImage)
+        with metrics.stage("image_extract") as stage:
+            image.extract(threshold=200)
+            stage["bytes"] = len(image.bit_array_black) + len(image.bit_array_red)
         # NOTE: Enable to debug raw black/red images
         # image.save(f"{infile}_resized.png")
         # image.save(f"{infile}_black.bmp", monochrome=True, color="black")
         # image.save(f"{infile}_red.bmp", monochrome=True, color="red")
 
-        if config.isDisplayToScreen:
+        return bytes(image.bit_array_black), bytes(image.bit_array_red)
+
+    def upload_frame(self, black, red):
+        config = self.config
+        if not config.isDisplayToScreen:
+            return
+
+        from epd_hidapi.host.panel import Panel
+        with self.metrics.stage("upload") as stage:
             panel = Panel()
-            panel.upload_image(image.bit_array_black, image.bit_array_red)
+            if config.get("compressedTransfer", False):
+                from display_engine.codec import StreamingPanel
+                panel = StreamingPanel(panel)
+            if config.get("partialRefresh", False):
+                from display_engine.partial import PartialUpdateHelper
+                partialService = PartialUpdateHelper(
+                    width=config.imageWidth, height=config.imageHeight,
+                    max_partials=config.get("fullRefreshEvery", 10),
+                    max_hours=config.get("fullRefreshHours", 24),
+                    max_area_ratio=config.get("partialRefreshMaxArea", 0.3))
+                stage["bytes"] = partialService.upload(panel, black, red)
+            else:
+                panel.upload_image(black, red)
+                stage["bytes"] = len(black) + len(red)
+            if getattr(panel, "sent", None) is not None:
+                # What actually went over the wire for a compressed full upload
+                stage["bytes"] = panel.sent
+
+
+class CalendarDaemon:
+    # Runs the update cycle on an internal schedule instead of a fresh process per systemd timer tick.
+    # SIGHUP reloads config.json (and rebuilds the calendar services); SIGTERM/SIGINT stop after the current cycle.
+    # With triggerPort set, pings to a local HTTP listener start an update right away (see trigger.py).
+
+    def __init__(self, updater):
+        self.logger = logging.getLogger()
+        self.updater = updater
+        self.wake = threading.Event()
+        self.reload_requested = False
+        self.stop_requested = False
+        self.trigger_requested = False
+        self.trigger = None
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+        self.wake.set()
+
+    def handle_stop(self, signum, frame):
+        self.stop_requested = True
+        self.wake.set()
+
+    def handle_trigger(self):
+        self.trigger_requested = True
+        self.wake.set()
+
+    def start_trigger(self):
+        self.stop_trigger()
+        config = self.updater.config
+        port = config.get("triggerPort")
+        if port is None:
+            return
+        from trigger import TriggerServer
+        self.trigger = TriggerServer(self.handle_trigger, host=config.get("triggerHost", "127.0.0.1"), port=port,
+                                     token=config.get("triggerToken"))
+        try:
+            self.trigger.start()
+        except OSError as e:
+            # Scheduled updates still work without the listener
+            self.logger.error(f"Could not listen for refresh triggers: {e}")
+            self.trigger = None
+
+    def stop_trigger(self):
+        if self.trigger:
+            self.trigger.stop()
+            self.trigger = None
+
+    def next_delay(self):
+        config = self.updater.config
+        interval = config.get("daemonIntervalSeconds", 300)
+        jitter = config.get("daemonJitterSeconds", 30)
+        # Jitter spreads a fleet's requests out so they don't all hit the calendar servers at the same instant
+        return max(0, interval + random.uniform(-jitter, jitter))
+
+    def sleep(self, delay):
+        # Wait for the next scheduled update, a signal or a trigger. Clearing before checking the flag means a ping
+        # that arrives in between still wakes the wait; pings during an update start another one straight after it.
+        self.wake.clear()
+        if not self.trigger_requested:
+            self.wake.wait(delay)
+        if not self.trigger_requested or self.stop_requested or self.reload_requested:
+            return
 
+        # Debounce: a burst of pings (e.g. one push notification per edited calendar) becomes a single update once
+        # they have been quiet for triggerDebounceSeconds, or after triggerMaxDelaySeconds of continuous pings
+        config = self.updater.config
+        quiet = config.get("triggerDebounceSeconds", 5)
+        deadline = time.monotonic() + config.get("triggerMaxDelaySeconds", 30)
+        while not self.stop_requested:
+            self.wake.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.wake.wait(min(quiet, remaining)):
+                break
+        self.trigger_requested = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        self.start_trigger()
+
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.logger.info("Reloading configuration")
+                try:
+                    self.updater.load()
+                    self.start_trigger()
+                except Exception as e:
+                    # Keep running with the previous configuration rather than dying on a bad edit
+                    self.logger.error(f"reload error: {e}")
+
+            self.logger.info("Starting calendar update")
+            try:
+                self.updater.update()
+            except Exception as e:
+                self.logger.error(f"error: {e}")
+            self.logger.info("Completed calendar update")
+
+            if self.stop_requested:
+                break
+
+            delay = self.next_delay()
+            self.logger.info(f"Next update in {delay:.0f}s")
+            self.sleep(delay)
+
+        self.stop_trigger()
+        self.updater.close()
+        self.logger.info("Stopping calendar daemon")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the e-ink calendar display")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and update on an internal schedule instead of exiting after one update")
+    args = parser.parse_args()
+
+    # Create and configure logger
+    logging.basicConfig()
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    if args.daemon:
+        CalendarDaemon(CalendarUpdater()).run()
+        return
+
+    logger.info("Starting calendar update")
+
+    updater = None
+    try:
+        # Building the calendar services (e.g. Google OAuth) can fail too, and is handled like the update itself
+        updater = CalendarUpdater()
+        updater.update()
     except Exception as e:
         logger.error(f"error: {e}")
+        # An unreadable config.json is raised from here, as it always was
+        config = updater.config if updater else Config()
         if config.raiseExceptions:
             raise e
+    finally:
+        if updater:
+            updater.close()
 
     logger.info("Completed calendar update")
 
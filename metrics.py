@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage metrics for an update run. Each stage (a calendar fetch, normalization, should_refresh, the HTML build,
+the screenshot, every image step and the panel upload) records its wall time, the process' peak RSS and the bytes
+it transferred. At the end of the run the stages are written as a JSON run record and as a Prometheus
+textfile-collector file, so a fleet can be scraped through node_exporter.
+"""
+
+import contextlib
+import datetime as dt
+import json
+import logging
+import os
+import pathlib
+import platform
+import socket
+import threading
+import time
+
+from atomic import write_atomic
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is reported as 0 there
+    resource = None
+
+PROMETHEUS_PREFIX = "maginkcal"
+
+
+def peak_rss():
+    # High-water mark of the resident set size of this process, in bytes
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss if platform.system() == "Darwin" else maxrss * 1024
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+
+    def __init__(self, metrics_dir=None):
+        self.logger = logging.getLogger(__name__)
+        self._path = str(pathlib.Path(__file__).parent.absolute())
+        self.metrics_dir = metrics_dir or f"{self._path}/metrics"
+        self.lock = threading.Lock()
+        # Stages can run on several threads at once (calendar fetches), so each thread keeps its own nesting
+        self.local = threading.local()
+        self.begin()
+
+    def begin(self):
+        # Start a new run record; a long-running process calls this once per update
+        with self.lock:
+            self.stages = []
+            self.started = dt.datetime.now(dt.timezone.utc)
+            self.start_time = time.perf_counter()
+
+    def active(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def inherited_labels(self, labels):
+        # Nested stages inherit the labels of the enclosing stage (e.g. the calendar a normalization belongs to)
+        stack = self.active()
+        merged = dict(stack[-1]["labels"]) if stack else {}
+        merged.update(labels)
+        return merged
+
+    @contextlib.contextmanager
+    def bind(self, stages):
+        # Record this thread's stages into the given run's stage list (self.stages when it began). Work that outlives
+        # its run, like a fetch past the deadline, then can't leak into the run that begin() started after it.
+        previous = getattr(self.local, "stages", None)
+        self.local.stages = stages
+        try:
+            yield
+        finally:
+            self.local.stages = previous
+
+    def append(self, record):
+        with self.lock:
+            stages = getattr(self.local, "stages", None)
+            (self.stages if stages is None else stages).append(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        # Time the body of the with block. The yielded record can be given its size directly (record["bytes"]),
+        # or add_bytes can be called from anywhere on the same thread while the stage is active.
+        record = {"stage": name, "labels": self.inherited_labels(labels), "bytes": 0}
+        rss_before = peak_rss()
+        start = time.perf_counter()
+        self.active().append(record)
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            self.active().pop()
+            record["seconds"] = time.perf_counter() - start
+            record["peakRssBytes"] = peak_rss()
+            record["rssGrowthBytes"] = record["peakRssBytes"] - rss_before
+            self.append(record)
+
+    def record(self, name, seconds, nbytes=0, **labels):
+        # Add a stage that was timed by the caller, e.g. work interleaved with streaming I/O
+        rss = peak_rss()
+        self.append({"stage": name, "labels": self.inherited_labels(labels), "bytes": nbytes, "seconds": seconds,
+                     "peakRssBytes": rss, "rssGrowthBytes": 0})
+
+    def add_bytes(self, nbytes):
+        # Count transferred bytes against every stage active on this thread (a no-op outside of one)
+        for record in self.active():
+            record["bytes"] += nbytes
+
+    def run_record(self, error=None):
+        with self.lock:
+            stages = list(self.stages)
+        return {
+            "host": socket.gethostname(),
+            "started": self.started.isoformat(),
+            "seconds": time.perf_counter() - self.start_time,
+            "peakRssBytes": peak_rss(),
+            "ok": error is None,
+            "error": error,
+            "stages": stages,
+        }
+
+    def prometheus(self, run):
+        # Stages with the same name and labels (e.g. two flushes of one step) are summed into one sample
+        samples = {}
+        for record in run["stages"]:
+            key = (record["stage"], tuple(sorted(record["labels"].items())))
+            sample = samples.setdefault(key, {"seconds": 0, "bytes": 0, "peakRssBytes": 0, "errors": 0})
+            sample["seconds"] += record["seconds"]
+            sample["bytes"] += record["bytes"]
+            sample["peakRssBytes"] = max(sample["peakRssBytes"], record["peakRssBytes"])
+            sample["errors"] += 1 if record.get("error") else 0
+
+        metrics = [
+            ("stage_seconds", "seconds", "Wall time of each update stage in the last run"),
+            ("stage_bytes", "bytes", "Bytes transferred by each update stage in the last run"),
+            ("stage_peak_rss_bytes", "peakRssBytes", "Peak resident set size of the process at the end of each stage"),
+            ("stage_errors", "errors", "Stages that raised in the last run"),
+        ]
+        lines = []
+        for metric, field, help_text in metrics:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} gauge")
+            for (stage, labels), sample in samples.items():
+                labels = format_labels(dict(labels, stage=stage))
+                lines.append(f"{PROMETHEUS_PREFIX}_{metric}{labels} {sample[field]}")
+
+        started = dt.datetime.fromisoformat(run["started"]).timestamp()
+        for metric, value, help_text in [
+            ("run_timestamp_seconds", started, "Start time of the last run"),
+            ("run_seconds", run["seconds"], "Wall time of the last run"),
+            ("run_peak_rss_bytes", run["peakRssBytes"], "Peak resident set size of the process"),
+            ("run_success", 1 if run["ok"] else 0, "Whether the last run completed without an error"),
+        ]:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{metric} gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, error=None):
+        # Write the run record (run.json) and the Prometheus textfile (maginkcal.prom) to metrics_dir
+        run = self.run_record(error)
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        write_atomic(f"{self.metrics_dir}/run.json", json.dumps(run, indent=2))
+        write_atomic(f"{self.metrics_dir}/{PROMETHEUS_PREFIX}.prom", self.prometheus(run))
+
+        summary = ", ".join(f"{record['stage']} {record['seconds'] * 1000:.0f}ms" for record in run["stages"])
+        self.logger.info(f"Run metrics: {summary}")
+        return run
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        metrics = Metrics(metrics_dir)
+        with metrics.stage("fetch", calendar="Family"):
+            metrics.add_bytes(2048)
+            with metrics.stage("normalize"):
+                time.sleep(0.01)
+        with metrics.stage("upload") as stage:
+            stage["bytes"] = 2 * 768 * 960 // 8
+        metrics.write()
+
+        with open(f"{metrics_dir}/{PROMETHEUS_PREFIX}.prom") as fo:
+            print(fo.read())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache from a hash of the rendered view model to the final black/red bitplanes. Views that look identical (even if
+the underlying events differ in ways that never reach the screen) skip the screenshot and image pipeline entirely.
+"""
+
+# Add root to path so modules in the parent directory are accessible
+import os
+import sys
+here = os.path.dirname(__file__)
+sys.path.append(os.path.join(here, '..'))
+
+import hashlib
+import json
+import logging
+import pathlib
+import struct
+
+from atomic import write_atomic
+
+
+class FrameCache:
+
+    def __init__(self, cache_dir=None, max_entries=16):
+        self.logger = logging.getLogger(__name__)
+        self._path = str(pathlib.Path(__file__).parent.absolute())
+        self.cache_dir = cache_dir or f"{self._path}/frame_cache"
+        self.max_entries = max_entries
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, view, settings):
+        # The view model holds everything drawn on screen; settings hold everything that changes how it's drawn
+        text = json.dumps({"view": view, "settings": settings}, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def load(self, key):
+        try:
+            with open(f"{self.cache_dir}/{key}.bin", "rb") as fo:
+                data = fo.read()
+        except FileNotFoundError:
+            return None
+
+        # Layout: length of the black plane, black plane, red plane
+        (black_len,) = struct.unpack_from("<I", data)
+        self.logger.info(f"Frame cache hit: {key[:12]}")
+        return data[4:4 + black_len], data[4 + black_len:]
+
+    def store(self, key, black, red):
+        black = bytes(black)
+        red = bytes(red)
+        write_atomic(f"{self.cache_dir}/{key}.bin", struct.pack("<I", len(black)) + black + red)
+        self.prune()
+
+    def discard(self, key):
+        try:
+            os.remove(f"{self.cache_dir}/{key}.bin")
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        # Keep only the most recently written frames
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".bin")),
+                         key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            os.remove(entry.path)
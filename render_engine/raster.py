@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pillow render backend. Draws the same layout as calendar_template.html (today panel, day names, the week grid with
+badges and "+x more" overflow) straight onto an image, without an X server or browser.
+"""
+
+import logging
+import pathlib
+
+from PIL import Image, ImageDraw, ImageFont
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+RED = (255, 0, 0)
+GRAY = (108, 117, 125)
+
+# Colors of the bootstrap classes used by the HTML template
+TEXT_COLORS = {"": BLACK, "text-muted": GRAY, "text-danger": RED}
+BADGE_COLORS = {"badge-dark": (BLACK, WHITE), "badge-danger": (RED, WHITE), "badge-light": (WHITE, BLACK)}
+
+# The Quattrocento fonts have no arrow glyphs, so use guillemets for multiday events
+ARROWS = {"rarr": "» ", "larr": "« ", "": ""}
+
+
+class RasterRenderer:
+    def __init__(self, width=960, height=768):
+        self.logger = logging.getLogger(__name__)
+        self._path = str(pathlib.Path(__file__).parent.absolute())
+        self.width = width
+        self.height = height
+        self.fonts = {}
+
+    def font(self, size, bold=True):
+        key = (int(size), bold)
+        if key not in self.fonts:
+            name = "Quattrocento-Bold.ttf" if bold else "Quattrocento-Regular.ttf"
+            self.fonts[key] = ImageFont.truetype(f"{self._path}/{name}", int(size))
+        return self.fonts[key]
+
+    def fit_text(self, draw, text, font, max_width):
+        # Truncate with an ellipsis, like the template's text-overflow: ellipsis
+        if draw.textlength(text, font=font) <= max_width:
+            return text
+        while text and draw.textlength(text + "…", font=font) > max_width:
+            text = text[:-1]
+        return text + "…"
+
+    def draw_centered(self, draw, box, text, font, fill):
+        left, top, right, bottom = box
+        x = (left + right) / 2
+        y = (top + bottom) / 2
+        draw.text((x, y), text, font=font, fill=fill, anchor="mm")
+
+    def draw_event(self, draw, x, y, max_width, event, font, line_height):
+        # Draw a single event line: optional time badge followed by the (bold) summary
+        text_color = TEXT_COLORS.get(event["text_style"], BLACK)
+        baseline = y + line_height / 2
+
+        if event["time"]:
+            badge_bg, badge_fg = BADGE_COLORS.get(event["badge_style"], (BLACK, WHITE))
+            pad = max(2, line_height // 8)
+            badge_width = draw.textlength(event["time"], font=font) + 2 * pad
+            draw.rectangle((x, y + 1, x + badge_width, y + line_height - 1), fill=badge_bg)
+            draw.text((x + pad, baseline), event["time"], font=font, fill=badge_fg, anchor="lm")
+            x += badge_width + pad
+            max_width -= badge_width + pad
+
+        summary = self.fit_text(draw, ARROWS.get(event["arrow"], "") + event["summary"], font, max_width)
+        draw.text((x, baseline), summary, font=font, fill=text_color, anchor="lm")
+
+    def draw_more(self, draw, x, y, day, font, line_height):
+        draw.text((x, y + line_height / 2), f"+{day['more']} more...", font=font, fill=GRAY, anchor="lm")
+
+    def draw_header(self, draw, view, header_height):
+        # Month/day on the left third, today's events centered on the right two thirds
+        left_width = self.width // 3
+        size = header_height
+        font = self.font(size)
+        while size > 10 and (draw.textlength(view["date_text"], font=font) > left_width - 20 or
+                             font.getbbox(view["date_text"])[3] > header_height - 10):
+            size -= 4
+            font = self.font(size)
+        self.draw_centered(draw, (0, 0, left_width, header_height), view["date_text"], font, BLACK)
+
+        today = next((day for day in view["days"] if day["date"] == view["today"]), None)
+        if today is None:
+            return
+
+        lines = len(today["events"]) + (1 if today["more"] else 0)
+        if not lines:
+            return
+        line_height = min(header_height // 4, (header_height - 20) // lines)
+        font = self.font(line_height * 0.8)
+        y = (header_height - lines * line_height) // 2
+        x = left_width + 20
+        for event in today["events"]:
+            self.draw_event(draw, x, y, self.width - x - 20, event, font, line_height)
+            y += line_height
+        if today["more"]:
+            self.draw_more(draw, x, y, today, self.font(line_height * 0.8, bold=False), line_height)
+
+    def render(self, view, outfile):
+        self.logger.info('Drawing calendar image')
+        image = Image.new("RGB", (self.width, self.height), WHITE)
+        draw = ImageDraw.Draw(image)
+
+        header_height = self.height // 5
+        names_height = self.height // 14
+        self.draw_header(draw, view, header_height)
+
+        # Days of week
+        col_width = self.width / 7
+        font = self.font(names_height * 0.8)
+        for i, day_text in enumerate(view["days_of_week"]):
+            box = (i * col_width, header_height, (i + 1) * col_width, header_height + names_height)
+            self.draw_centered(draw, box, day_text.upper(), font, BLACK)
+
+        # Week grid
+        top = header_height + names_height
+        rows = max(1, len(view["days"]) // 7)
+        row_height = (self.height - top) / rows
+        date_height = row_height * 0.38
+        max_lines = max([len(day["events"]) + (1 if day["more"] else 0) for day in view["days"]] + [1])
+        line_height = int(min(row_height * 0.2, (row_height - date_height) / max_lines))
+        event_font = self.font(line_height * 0.8)
+        more_font = self.font(line_height * 0.8, bold=False)
+        date_font = self.font(date_height * 0.8)
+
+        for i, day in enumerate(view["days"]):
+            left = (i % 7) * col_width
+            y = top + (i // 7) * row_height
+            date_box = (left, y, left + col_width, y + date_height)
+
+            if day["style"] == "datecircle":
+                cx = left + col_width / 2
+                cy = y + date_height / 2
+                radius = date_height / 2
+                draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=RED)
+                self.draw_centered(draw, date_box, str(day["date"].day), date_font, WHITE)
+            else:
+                color = GRAY if "text-muted" in day["style"] else BLACK
+                self.draw_centered(draw, date_box, str(day["date"].day), date_font, color)
+
+            x = left + 2
+            y += date_height
+            for event in day["events"]:
+                self.draw_event(draw, x, y, col_width - 4, event, event_font, line_height)
+                y += line_height
+            if day["more"]:
+                self.draw_more(draw, x, y, day, more_font, line_height)
+
+        image.save(outfile)
+        self.logger.info(f"Calendar image saved to {outfile}")
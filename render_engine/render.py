@@ -13,17 +13,34 @@ from datetime import date, timedelta
 from subprocess import call
 
 from config import Config
-from render_engine.template import template as t
+from metrics import Metrics
+from render_engine.template import CompiledTemplate, load_template
+
+# Precompiled fragments for the repeated parts of the calendar. These produce the same markup as the equivalent
+# render_engine.template.template() calls, without rebuilding the tags for every day and event.
+DAY_NAME_FRAGMENT = CompiledTemplate("<li class='font-weight-bold text-uppercase'>{day}</li>")
+DAY_FRAGMENT = CompiledTemplate("<li><div class='{style}'>{day}</div>{events}</li>")
+EVENT_FRAGMENT = CompiledTemplate("<div class='event {text_style}'>{badge} <b>{summary}</b></div>")
+BADGE_FRAGMENT = CompiledTemplate("<span class='badge {badge_style}'>{time}</span>")
+ARROW_FRAGMENT = CompiledTemplate("<b>&{arrow};</b>")
+MORE_FRAGMENT = CompiledTemplate("<div class='event text-muted'><i>+{more} more...</i></div>")
+
+# Height of the week grid in rem, shared by its rows (11.5rem each with the default of 5 weeks)
+GRID_HEIGHT_REM = 57.5
 
 
 class RenderHelper:
-    def __init__(self, events, start_date, today, battery_level=100):
+    def __init__(self, events, start_date, today, battery_level=100, worker=None, config=None,
+                 metrics=None):
         self.logger = logging.getLogger(__name__)
         self._path = str(pathlib.Path(__file__).parent.absolute())
         self.events = events
         self.start_date = start_date
         self.today = today
         self.battery_level = battery_level
+        self.worker = worker
+        self.config = config
+        self.metrics = metrics or Metrics()
 
     def get_screenshot(self, uri, outfile, width=768, height=960):
         self.logger.info('Capturing calendar screenshot')
@@ -69,36 +86,23 @@ class RenderHelper:
                     str(datetime_obj.hour), datetime_str)
         return datetime_str
 
-    def build_calendar_list(self):
-        calendar_list = []
+    def build_calendar_list(self, num_days=35):
+        calendar_list = [[] for _ in range(num_days)]
 
-        NUM_DAYS = 35
-        for i in range(NUM_DAYS):
-            calendar_list.append([])
-
-        # for each item in the eventList, add them to the relevant day in our calendar list
+        # for each item in the eventList, add it to every day in our calendar list it covers (clipped to the view).
+        # Events arrive sorted by start, so each day's list stays in start order.
         for event in self.events:
-            day = self.get_day_in_cal(
-                self.start_date, event['startDatetime'].date())
-            if day >= 0 and day <= NUM_DAYS:
+            first = self.get_day_in_cal(
+                self.start_date, event.startDatetime.date())
+            last = self.get_day_in_cal(
+                self.start_date, event.endDatetime.date()) if event.isMultiday else first
+
+            for day in range(max(first, 0), min(last, num_days - 1) + 1):
                 calendar_list[day].append(event)
-            if event['isMultiday']:
-                day = self.get_day_in_cal(
-                    self.start_date, event['endDatetime'].date())
-                if day <= NUM_DAYS:
-                    calendar_list[day].append(event)
 
         return calendar_list
 
-    def process_inputs(self):
-        self.logger.info('Rendering calendar HTML')
-
-        # retrieve calendar configuration
-        config = Config()
-
-        # build calendar list from events
-        calendar_days = self.build_calendar_list()
-
+    def get_battery_text(self, config):
         # Insert battery icon
         # batteryDisplayMode - 0: do not show / 1: always show / 2: show when battery is low
         if config.batteryDisplayMode == 0:
@@ -119,19 +123,16 @@ class RenderHelper:
         elif config.batteryDisplayMode == 2 and self.battery_level >= 20.0:
             battery_text = 'batteryHide'
 
-        # Populate the day of week row
-        l = []
-        for d in range(0, 7):
-            l.append(t('li', c='font-weight-bold text-uppercase',
-                       body=config.dayOfWeekText[(d + config.weekStartDay) % 7]))
-        cal_days_of_week = '\n'.join(l)
+        return battery_text
 
-        # Populate the date and events
-        cal_events = []
-        todays_events = []
+    def build_view(self, config):
+        # Build the structured model of everything that ends up on screen. Each render backend draws from this,
+        # so the HTML and raster outputs always agree on what is shown.
+        calendar_days = self.build_calendar_list(num_days=config.get("numWeeks", 5) * 7)
+
+        days = []
         for i, entry in enumerate(calendar_days):
             current_date = self.start_date + timedelta(days=i)
-            day_of_month = current_date.day
 
             # Set day style
             if current_date == self.today:
@@ -151,85 +152,151 @@ class RenderHelper:
                 if current_date.month != self.today.month:
                     text_style = "text-muted"
                     badge_style = "badge-light"
-                elif event['isUpdated']:
+                elif event.isUpdated:
                     text_style = "text-danger"
                     badge_style = "badge-danger"
                 else:
                     text_style = ""
                     badge_style = "badge-dark"
 
-                event_time = self.get_short_time(
-                    event['startDatetime'], config.is24hour)
-
-                if event['isMultiday'] and event['startDatetime'].date() == current_date:
-                    event_summary = t('b', body="&rarr;") + event['summary']
-                elif event['isMultiday'] and event['startDatetime'].date() != current_date:
-                    event_summary = t('b', body="&larr;") + event['summary']
+                # Multiday events point forward on their first day and back on the days after
+                if event.isMultiday and event.startDatetime.date() == current_date:
+                    arrow = "rarr"
+                elif event.isMultiday and event.startDatetime.date() != current_date:
+                    arrow = "larr"
                 else:
-                    event_summary = event['summary']
-
-                time_badge = "" if event['allday'] else t(
-                    'span', c=f'badge {badge_style}', body=event_time)
-                events.append(
-                    t('div', c=f'event {text_style}', body=(
-                        time_badge, " ",
-                        t('b', body=event_summary.encode(
-                            'ascii', 'xmlcharrefreplace').decode("utf-8"))
-                    )
-                    )
-                )
-
-            # Remove events above the maximum and add "+x more"
-            if len(events) > config.maxEventsPerDay:
-                event_summary = f"+{len(events) - config.maxEventsPerDay} more..."
-                events = events[:config.maxEventsPerDay]
-                events.append(
-                    t('div', c='event text-muted',
-                      body=(t('i', body=event_summary)))
-                )
+                    arrow = ""
+
+                events.append({
+                    "time": "" if event.allday else self.get_short_time(
+                        event.startDatetime, config.is24hour),
+                    "summary": event.summary,
+                    "arrow": arrow,
+                    "text_style": text_style,
+                    "badge_style": badge_style,
+                })
+
+            # Remove events above the maximum and keep count of the "+x more"
+            more = max(0, len(events) - config.maxEventsPerDay)
+            days.append({
+                "date": current_date,
+                "style": c,
+                "events": events[:config.maxEventsPerDay],
+                "more": more,
+            })
+
+        return {
+            "today": self.today,
+            "date_text": f"{self.today.month}/{self.today.day}",
+            "battery_text": self.get_battery_text(config),
+            "days_of_week": [config.dayOfWeekText[(d + config.weekStartDay) % 7] for d in range(0, 7)],
+            "days": days,
+        }
+
+    def render_events_html(self, day):
+        events = []
+        for event in day["events"]:
+            event_summary = event["summary"]
+            if event["arrow"]:
+                event_summary = ARROW_FRAGMENT.render(arrow=event["arrow"]) + event_summary
+
+            time_badge = "" if not event["time"] else BADGE_FRAGMENT.render(
+                badge_style=event["badge_style"], time=event["time"])
+            events.append(EVENT_FRAGMENT.render(
+                text_style=event["text_style"], badge=time_badge,
+                summary=event_summary.encode('ascii', 'xmlcharrefreplace').decode("utf-8")))
+
+        if day["more"]:
+            events.append(MORE_FRAGMENT.render(more=day["more"]))
+
+        return events
+
+    def render_html(self, view):
+        # Returns the complete document as bytes, ready for the render backend
+        # Populate the day of week row
+        cal_days_of_week = '\n'.join(DAY_NAME_FRAGMENT.render(day=day_text) for day_text in view["days_of_week"])
+
+        # Populate the date and events
+        cal_events = []
+        todays_events = []
+        for day in view["days"]:
+            events = self.render_events_html(day)
 
             # Add the day's events
-            cal_events.append(
-                t('li', body=(
-                    t('div', c=c, body=day_of_month),
-                    "".join(events)
-                )
-                )
-            )
+            cal_events.append(DAY_FRAGMENT.render(style=day["style"], day=day["date"].day, events="".join(events)))
 
-            if current_date == self.today:
+            if day["date"] == view["today"]:
                 # Also add to today's events
                 todays_events = events
 
         # Join is faster/more memory efficient than += for strings
         cal_events_text = '\n'.join(cal_events)
 
-        # Read html template
-        with open(f"{self._path}/calendar_template.html", 'r') as fo:
-            calendar_template = fo.read()
-
-        # Append the bottom and write the file
-        calendar_html = open(f"{self._path}/calendar.html", "w")
-        calendar_html.write(calendar_template.format(
-            date=str(f"{self.today.month}/{self.today.day}"),
-            battery_text=battery_text, days_of_week=cal_days_of_week,
-            events_month=cal_events_text, events_today="\n".join(todays_events)))
-        calendar_html.close()
+        # The rows fill the same height whatever numWeeks is
+        rows = max(1, len(view["days"]) // 7)
+
+        calendar_template = load_template(f"{self._path}/calendar_template.html")
+        return calendar_template.render(
+            date=view["date_text"], row_height=f"{GRID_HEIGHT_REM / rows:g}",
+            battery_text=view["battery_text"], days_of_week=cal_days_of_week,
+            events_month=cal_events_text, events_today="\n".join(todays_events)).encode("utf-8")
+
+    def process_inputs(self, view=None, outfile=None):
+        # retrieve calendar configuration, unless the caller already loaded it
+        config = self.config or Config()
+        # the image the panel is updated from, unless the caller wants it elsewhere
+        outfile = outfile or f"{self._path}/calendar.png"
+
+        # build the view model from events, unless the caller already did
+        if view is None:
+            view = self.build_view(config)
+
+        if config.get("renderBackend", "html") == "pillow":
+            self.logger.info('Rendering calendar with Pillow')
+            from render_engine.raster import RasterRenderer
+            with self.metrics.stage("raster") as stage:
+                RasterRenderer(width=config.screenWidth, height=config.screenHeight).render(
+                    view, outfile)
+                stage["bytes"] = os.path.getsize(outfile)
+            return
 
-        self.get_screenshot(
-            f"file://{self._path}/calendar.html",
-            f"{self._path}/calendar.png",
-            width=config.screenWidth,
-            height=config.screenHeight
-        )
+        self.logger.info('Rendering calendar HTML')
+        with self.metrics.stage("html") as stage:
+            html = self.render_html(view)
+            stage["bytes"] = len(html)
+
+        with self.metrics.stage("screenshot") as stage:
+            if self.worker:
+                # The long-lived worker takes the document directly and hands back the PNG
+                png = self.worker.render(html)
+                with open(outfile, "wb") as fo:
+                    fo.write(png)
+                stage["bytes"] = len(png)
+                return
+
+            # cutycapt can only load from a URL, so the document still goes through a file here
+            with open(f"{self._path}/calendar.html", "wb") as fo:
+                fo.write(html)
+
+            self.get_screenshot(
+                f"file://{self._path}/calendar.html",
+                outfile,
+                width=config.screenWidth,
+                height=config.screenHeight
+            )
+            stage["bytes"] = os.path.getsize(outfile)
 
 
 if __name__ == "__main__":
     import pickle
 
+    from event import Event
+
     logging.basicConfig(level=logging.INFO)
 
     events = pickle.loads(b'\x80\x04\x95\x0b\x03\x00\x00\x00\x00\x00\x00]\x94(}\x94(\x8c\x07summary\x94\x8c"Stay at Belmont Shore Beach Studio\x94\x8c\x06allday\x94\x88\x8c\rstartDatetime\x94\x8c\x08datetime\x94\x8c\x08datetime\x94\x93\x94C\n\x07\xe8\x08\x1e\x00\x00\x00\x00\x00\x00\x94\x8c\x04pytz\x94\x8c\x02_p\x94\x93\x94(\x8c\x13America/Los_Angeles\x94J\x90\x9d\xff\xffM\x10\x0e\x8c\x03PDT\x94t\x94R\x94\x86\x94R\x94\x8c\x0bendDatetime\x94h\x08C\n\x07\xe8\t\x02\x17;;\x0fB?\x94h\x10\x86\x94R\x94\x8c\x0fupdatedDatetime\x94h\x08C\n\x07\xe8\t\x02\x0b\x024\x08\xb6x\x94h\x10\x86\x94R\x94\x8c\tisUpdated\x94\x89\x8c\nisMultiday\x94\x88u}\x94(h\x02\x8c\rCSA Fruit Box\x94h\x04\x89h\x05h\x08C\n\x07\xe8\t\x04\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x13h\x08C\n\x07\xe8\t\x04\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x17h\x08C\n\x07\xe8\x04\x15\x15\x16&\x06\x06\xf8\x94h\x10\x86\x94R\x94h\x1b\x89h\x1c\x89u}\x94(h\x02\x8c\rCSA Fruit Box\x94h\x04\x89h\x05h\x08C\n\x07\xe8\t\x0b\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x13h\x08C\n\x07\xe8\t\x0b\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x17h\x08C\n\x07\xe8\x04\x15\x15\x16&\x06\x06\xf8\x94h\x10\x86\x94R\x94h\x1b\x89h\x1c\x89u}\x94(h\x02\x8c\rCSA Fruit Box\x94h\x04\x89h\x05h\x08C\n\x07\xe8\t\x12\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x13h\x08C\n\x07\xe8\t\x12\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x17h\x08C\n\x07\xe8\x04\x15\x15\x16&\x06\x06\xf8\x94h\x10\x86\x94R\x94h\x1b\x89h\x1c\x89u}\x94(h\x02\x8c\rCSA Fruit Box\x94h\x04\x89h\x05h\x08C\n\x07\xe8\t\x19\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x13h\x08C\n\x07\xe8\t\x19\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x17h\x08C\n\x07\xe8\x04\x15\x15\x16&\x06\x06\xf8\x94h\x10\x86\x94R\x94h\x1b\x89h\x1c\x89u}\x94(h\x02\x8c\rCSA Fruit Box\x94h\x04\x89h\x05h\x08C\n\x07\xe8\n\x02\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x13h\x08C\n\x07\xe8\n\x02\x0e\x1e\x00\x00\x00\x00\x94h\x10\x86\x94R\x94h\x17h\x08C\n\x07\xe8\x04\x15\x15\x16&\x06\x06\xf8\x94h\x10\x86\x94R\x94h\x1b\x89h\x1c\x89ue.')
+    # The sample was captured as dicts, before the Event model existed
+    events = [Event(uid=None, **event) for event in events]
     # duplicate last event for testing
     events.append(events[-1])
     events.append(events[-1])
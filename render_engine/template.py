@@ -1,4 +1,9 @@
 
+import functools
+import os
+import string
+
+
 def __o(inner):
     return f"<{inner.rstrip()}>"
 
@@ -11,7 +16,7 @@ def __c(tag):
 
 # Only a small subset of html tags are needed right now
 # for all others, use the ext_attr dictionary
-def template(tag, c="", id="", ext_attr={}, body=('')):
+def template(tag, c="", id="", ext_attr=None, body=('')):
     inner = f"{tag} "
     inner += f"class='{c}' " if c else ""
     inner += f"id='{id}' " if id else ""
@@ -24,6 +29,31 @@ def template(tag, c="", id="", ext_attr={}, body=('')):
     return __o(inner) + "".join(body) + __c(tag)
 
 
+class CompiledTemplate:
+    # A str.format-style template parsed once into literal and field parts, so rendering is a single join
+    def __init__(self, text):
+        self.parts = []
+        for literal, field, _, _ in string.Formatter().parse(text):
+            if literal:
+                self.parts.append((literal, None))
+            if field is not None:
+                self.parts.append((None, field))
+
+    def render(self, **fields):
+        return "".join(literal if field is None else str(fields[field]) for literal, field in self.parts)
+
+
+def load_template(path):
+    # Each template file is read and parsed once per process, and again after it's edited (a daemon keeps running)
+    return compile_template(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=16)
+def compile_template(path, mtime):
+    with open(path, 'r') as fo:
+        return CompiledTemplate(fo.read())
+
+
 if __name__ == "__main__":
     """
     <li class='font-weight-bold text-uppercase'>S</li>
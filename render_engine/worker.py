@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-lived render worker for the HTML backend. It owns a single virtual framebuffer (Xvfb) for the lifetime of the
+process, so each render job only pays for the screenshot itself rather than an X server startup via xvfb-run. Jobs
+take the calendar HTML as bytes and return the PNG bytes; scratch files live on tmpfs (/dev/shm) when available.
+"""
+
+import logging
+import os
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+
+
+class RenderWorker:
+    def __init__(self, width=768, height=960, display=99, max_history=50):
+        self.logger = logging.getLogger(__name__)
+        self._path = str(pathlib.Path(__file__).parent.absolute())
+        self.width = width
+        self.height = height
+        self.display = display
+        self.server = None
+        self.job_times = []
+        self.max_history = max_history
+        self.needs_server = platform.system() == "Linux"
+        self.scratch_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+    def is_running(self):
+        return not self.needs_server or (self.server is not None and self.server.poll() is None)
+
+    def start(self):
+        if self.is_running():
+            return
+
+        # Pick the first display that isn't taken by another X server
+        while os.path.exists(f"/tmp/.X11-unix/X{self.display}"):
+            self.display += 1
+
+        self.logger.info(f"Starting Xvfb on :{self.display}")
+        self.server = subprocess.Popen(
+            ["Xvfb", f":{self.display}", "-screen", "0", f"{self.width}x{self.height}x24", "-nolisten", "tcp"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # Wait for the server socket to appear before handing out jobs
+        deadline = time.monotonic() + 10
+        while not os.path.exists(f"/tmp/.X11-unix/X{self.display}"):
+            if self.server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"Xvfb failed to start on :{self.display}")
+            time.sleep(0.05)
+
+    def stop(self):
+        if self.server is not None and self.server.poll() is None:
+            self.logger.info(f"Stopping Xvfb on :{self.display}")
+            self.server.terminate()
+            try:
+                self.server.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+        self.server = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def capture(self, html):
+        # The HTML is loaded from tmpfs, so point relative stylesheet/font/image links back at render_engine
+        html = html.replace(b"<head>", f"<head>\n    <base href=\"file://{self._path}/\">".encode("utf-8"), 1)
+
+        with tempfile.TemporaryDirectory(dir=self.scratch_dir) as scratch:
+            infile = f"{scratch}/calendar.html"
+            outfile = f"{scratch}/calendar.png"
+            with open(infile, "wb") as fo:
+                fo.write(html)
+
+            env = dict(os.environ)
+            if self.needs_server:
+                env["DISPLAY"] = f":{self.display}"
+            subprocess.run(["cutycapt", f"--url=file://{infile}", f"--min-width={self.width}",
+                            f"--min-height={self.height}", "--smooth", f"--out={outfile}"],
+                           env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            with open(outfile, "rb") as fo:
+                png = fo.read()
+
+        if not png:
+            raise RuntimeError("Render produced an empty image")
+        return png
+
+    def render(self, html):
+        # Render the HTML document (bytes) and return the PNG bytes, restarting the X server if it or the job crashed
+        start = time.monotonic()
+        self.start()
+
+        try:
+            png = self.capture(html)
+        except (subprocess.CalledProcessError, RuntimeError, OSError) as e:
+            self.logger.warning(f"Render job failed ({e}); restarting worker and retrying")
+            self.restart()
+            png = self.capture(html)
+
+        elapsed = time.monotonic() - start
+        self.job_times = (self.job_times + [elapsed])[-self.max_history:]
+        self.logger.info(f"Render job completed in {elapsed * 1000:.0f}ms")
+        return png
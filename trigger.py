@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local HTTP listener for "refresh now" pings, so that calendar edits can reach the panel without waiting for the next
+scheduled update: Google Calendar push notifications relayed by a reverse proxy, a home automation hook, or simply
+curl -X POST http://127.0.0.1:8765/refresh. Debouncing bursts of pings is up to the caller (see CalendarDaemon).
+
+If a token is configured, a ping must carry it, either as the channel token Google echoes back in push notifications
+(X-Goog-Channel-Token) or as "Authorization: Bearer <token>".
+"""
+
+import hmac
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class TriggerServer:
+
+    def __init__(self, callback, host="127.0.0.1", port=8765, token=None, path="/refresh"):
+        self.logger = logging.getLogger(__name__)
+        # Called from the server's request threads, so it should only flag the request and return
+        self.callback = callback
+        self.host = host
+        self.port = port
+        self.token = token
+        self.path = path
+        self.server = None
+
+    def authorized(self, headers):
+        if not self.token:
+            return True
+        supplied = headers.get("X-Goog-Channel-Token")
+        if supplied is None:
+            authorization = headers.get("Authorization", "")
+            if authorization.startswith("Bearer "):
+                supplied = authorization[len("Bearer "):]
+        return supplied is not None and hmac.compare_digest(supplied.encode("utf-8"), self.token.encode("utf-8"))
+
+    def handler(self):
+        trigger = self
+
+        class TriggerHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # Drain the body (push notifications have none, hooks might send some)
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if urlsplit(self.path).path != trigger.path:
+                    self.send_error(404)
+                    return
+                if not trigger.authorized(self.headers):
+                    trigger.logger.warning(f"Rejected refresh trigger from {self.client_address[0]}")
+                    self.send_error(403)
+                    return
+
+                # Google sends a "sync" message when a channel is set up; it doesn't mean anything changed
+                if self.headers.get("X-Goog-Resource-State") != "sync":
+                    trigger.logger.info(f"Refresh triggered by {self.client_address[0]}")
+                    trigger.callback()
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                # Only POST triggers a refresh, so that link previews and crawlers can't
+                self.send_error(405)
+
+            def log_message(self, format, *args):
+                trigger.logger.debug(format % args)
+
+        return TriggerHandler
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler())
+        self.server.daemon_threads = True
+        # With port 0 the OS picks a free port
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, name="trigger", daemon=True).start()
+        self.logger.info(f"Listening for refresh triggers on http://{self.host}:{self.port}{self.path}")
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == "__main__":
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    pings = []
+    server = TriggerServer(lambda: pings.append(1), port=0, token="secret")
+    server.start()
+    url = f"http://127.0.0.1:{server.port}/refresh"
+    for headers in ({"Authorization": "Bearer secret"}, {"X-Goog-Channel-Token": "secret"},
+                    {"X-Goog-Channel-Token": "secret", "X-Goog-Resource-State": "sync"},
+                    {"Authorization": "Bearer wrong"}):
+        try:
+            status = urlopen(Request(url, data=b"", headers=headers)).status
+        except HTTPError as e:
+            status = e.code
+        print(headers, status)
+    server.stop()
+    print(f"{len(pings)} refreshes triggered")